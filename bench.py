@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks do trabalho por mensagem do client.py.
+
+Mede, sem rede, o custo de CPU de cada etapa que o cliente executa por
+mensagem: Box/SecretBox, montagem do envelope (b64 + json.dumps), a
+reabertura do histórico na tela de conversas e o processamento de um lote
+de fetch_blobs pelo Inbox.
+
+Os resultados ficam em .bench/<commit>.json e cada execução é comparada com
+a anterior (ou com --compare <arquivo|commit>); casos que ficarem mais lentos
+que --threshold são listados como regressão e o script sai com código 1.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from nacl.public import Box, PrivateKey
+from nacl.secret import SecretBox
+from nacl.utils import random
+
+import client
+from client import b64, ub64, key_id, seal_private, open_private, seal_group, open_group
+
+RESULTS_DIR = ".bench"
+TEXT = "mensagem de teste com tamanho típico de chat, uns 60 bytes."
+
+
+# -------------------------------------------------------------------
+# Dados de entrada
+# -------------------------------------------------------------------
+class Fixture:
+    """Chaves e mensagens já cifradas, como chegariam do fetch_blobs."""
+
+    def __init__(self, history_size, batch_size):
+        self.alice = PrivateKey.generate()
+        self.bob = PrivateKey.generate()
+        self.alice_pub = bytes(self.alice.public_key)
+        self.alice_kid = key_id(self.alice_pub)
+        self.box = Box(self.alice, self.bob.public_key)       # alice -> bob
+        self.receiver = Box(self.bob, self.alice.public_key)  # bob abre o que alice enviou
+        self.group_key = random(SecretBox.KEY_SIZE)
+        self.group_box = SecretBox(self.group_key)
+
+        self.private_msg = self.fetched_private()
+        self.group_msg = self.fetched_group()
+        self.private_history = [self.fetched_private() for _ in range(history_size)]
+        self.group_history = [self.fetched_group() for _ in range(history_size)]
+        self.batch = self.mixed_batch(batch_size)
+
+    def fetched_private(self):
+        return {"type": "private", "from": "alice", "kid": self.alice_kid,
+                "blob": seal_private(self.box, TEXT), "meta": {}, "ts": "00:00:00"}
+
+    def fetched_group(self):
+        return {"type": "group", "group_id": "g1", "from": "alice",
+                "blob": seal_group(self.group_box, TEXT), "ts": "00:00:00"}
+
+    def key_distribution(self):
+        return {"type": "group_key", "group_id": "g1", "from": "alice", "kid": self.alice_kid,
+                "blob": b64(bytes(self.box.encrypt(self.group_key)))}
+
+    def mixed_batch(self, n):
+        """Lote típico: metade privado, metade grupo, uma distribuição de chave."""
+        batch = [self.key_distribution()]
+        while len(batch) < n:
+            batch.append(self.fetched_private() if len(batch) % 2 else self.fetched_group())
+        return batch
+
+
+# -------------------------------------------------------------------
+# Casos
+# -------------------------------------------------------------------
+def cases(fx):
+    """Devolve [(nome, função, operações por chamada)]."""
+    plain = TEXT.encode()
+    sealed = bytes(fx.box.encrypt(plain))
+    receiver = fx.receiver
+    group_sealed = bytes(fx.group_box.encrypt(plain))
+    payload = {"type": "send_blob", "kind": "private", "to": "bob", "from": "alice",
+               "kid": fx.alice_kid, "blob": fx.private_msg["blob"]}
+
+    def history(opener, entries):
+        def run():
+            for m in entries:
+                opener(m)
+        return run
+
+    def ingest():
+        inbox = client.Inbox(fx.bob)
+        inbox.on_notice = lambda text: None
+        inbox.learn("alice", fx.alice_pub)  # chave já em cache, como após o primeiro lote
+        # ingest() grava o horário de recebimento em cada mensagem; copia o lote
+        inbox.ingest([dict(m) for m in fx.batch])
+
+    return [
+        ("box.encrypt", lambda: fx.box.encrypt(plain), 1),
+        ("box.decrypt", lambda: receiver.decrypt(sealed), 1),
+        ("box.precompute", lambda: Box(fx.bob, fx.alice.public_key), 1),
+        ("secretbox.encrypt", lambda: fx.group_box.encrypt(plain), 1),
+        ("secretbox.decrypt", lambda: fx.group_box.decrypt(group_sealed), 1),
+        ("envelope.build", lambda: b64(sealed), 1),
+        ("envelope.parse", lambda: ub64(fx.private_msg["blob"]), 1),
+        ("payload.dumps", lambda: (json.dumps(payload) + "\n").encode(), 1),
+        ("seal_private", lambda: seal_private(fx.box, TEXT), 1),
+        ("open_private", lambda: open_private(receiver, fx.private_msg), 1),
+        ("seal_group", lambda: seal_group(fx.group_box, TEXT), 1),
+        ("open_group", lambda: open_group(fx.group_box, fx.group_msg), 1),
+        ("history.private", history(lambda m: open_private(receiver, m), fx.private_history), len(fx.private_history)),
+        ("history.group", history(lambda m: open_group(fx.group_box, m), fx.group_history), len(fx.group_history)),
+        ("inbox.ingest", ingest, len(fx.batch)),
+    ]
+
+
+def measure(fn, ops, min_time, repeat):
+    """Melhor tempo por operação (ns) entre ``repeat`` rodadas de ~``min_time`` s."""
+    fn()  # aquecimento
+    loops = 1
+    while True:
+        t0 = time.perf_counter_ns()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter_ns() - t0
+        if elapsed >= min_time * 1e9:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter_ns()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter_ns() - t0)
+    return best / (loops * ops)
+
+
+# -------------------------------------------------------------------
+# Armazenamento e comparação
+# -------------------------------------------------------------------
+def git_commit():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_results(ref):
+    """Aceita um caminho de arquivo ou um commit já medido em .bench/."""
+    path = ref if os.path.exists(ref) else os.path.join(RESULTS_DIR, f"{ref}.json")
+    with open(path) as f:
+        return json.load(f)
+
+
+def previous_results(commit):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    runs = []
+    for name in os.listdir(RESULTS_DIR):
+        if name.endswith(".json") and name != f"{commit}.json":
+            path = os.path.join(RESULTS_DIR, name)
+            runs.append((os.path.getmtime(path), path))
+    return load_results(max(runs)[1]) if runs else None
+
+
+def report(results, baseline, threshold):
+    print("=" * 70)
+    print(f"BENCH: {results['commit']} | Python {results['python']} | PyNaCl {results['pynacl']}")
+    if baseline:
+        print(f"Comparando com: {baseline['commit']}")
+    print("=" * 70)
+    print(f"{'caso':<20}{'ns/op':>12}{'anterior':>12}{'variação':>10}")
+
+    regressions = []
+    for name, ns in results["cases"].items():
+        before = baseline["cases"].get(name) if baseline else None
+        if before:
+            change = ns / before - 1
+            flag = "  ⚠️" if change > threshold else ""
+            print(f"{name:<20}{ns:>12,.0f}{before:>12,.0f}{change:>+9.1%}{flag}")
+            if change > threshold:
+                regressions.append(name)
+        else:
+            print(f"{name:<20}{ns:>12,.0f}{'-':>12}{'-':>10}")
+    print("-" * 70)
+    return regressions
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Micro-benchmarks por mensagem - Chat Seguro")
+    p.add_argument("--compare", help="Resultado de referência (arquivo ou commit em .bench/)")
+    p.add_argument("--threshold", default=0.10, type=float,
+                   help="Variação máxima aceita antes de acusar regressão (padrão 0.10 = 10%%)")
+    p.add_argument("--repeat", default=5, type=int, help="Rodadas por caso (usa a melhor)")
+    p.add_argument("--min-time", default=0.2, type=float, help="Duração mínima de cada rodada (s)")
+    p.add_argument("--history", default=1000, type=int, help="Mensagens no histórico reaberto")
+    p.add_argument("--batch", default=client.FETCH_BATCH, type=int, help="Mensagens por lote de fetch_blobs")
+    p.add_argument("--only", help="Roda só os casos que contêm este texto")
+    p.add_argument("--no-save", action="store_true", help="Não grava o resultado em .bench/")
+    args = p.parse_args()
+
+    # os logs de debug do client.py custariam mais que o próprio trabalho medido
+    logging.disable(logging.CRITICAL)
+
+    import nacl
+    commit = git_commit()
+    fx = Fixture(args.history, args.batch)
+    results = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "pynacl": nacl.__version__,
+        "cases": {},
+    }
+    for name, fn, ops in cases(fx):
+        if args.only and args.only not in name:
+            continue
+        results["cases"][name] = measure(fn, ops, args.min_time, args.repeat)
+
+    baseline = load_results(args.compare) if args.compare else previous_results(commit)
+    regressions = report(results, baseline, args.threshold)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{commit}.json")
+        if args.only and os.path.exists(path):
+            # execução parcial: mantém os demais casos já medidos neste commit
+            results["cases"] = {**load_results(path)["cases"], **results["cases"]}
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Resultado salvo em {path}")
+
+    if regressions:
+        print(f"❌ Regressão acima de {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -2,12 +2,23 @@
 import argparse
 import asyncio
 import base64
+import hashlib
 import json
 import os
 import ssl
+import stat
+import sys
+import textwrap
 import time
 import logging
 
+try:
+    import curses
+except ImportError:  # Windows sem o pacote windows-curses
+    curses = None
+
+import websockets
+from nacl.exceptions import CryptoError
 from nacl.public import Box, PrivateKey, PublicKey
 from nacl.secret import SecretBox
 
@@ -33,6 +44,10 @@ def b64(x: bytes) -> str:
 def ub64(s: str) -> bytes:
     return base64.b64decode(s.encode())
 
+def key_id(pub: bytes) -> str:
+    """ID curto (16 hex) de uma chave pública; vai nas mensagens no lugar da chave."""
+    return hashlib.blake2b(pub, digest_size=8).hexdigest()
+
 def short_b64(x: bytes, n=10) -> str:
     try:
         return b64(x)[:n] + "..."
@@ -43,6 +58,88 @@ def hex_preview(data: bytes, length=16) -> str:
     """Mostra preview em hexadecimal dos primeiros bytes"""
     return data[:length].hex() + ("..." if len(data) > length else "")
 
+# -------------------------------------------------------------------
+# Envelopes (caminho por mensagem, também usado por bench.py)
+# -------------------------------------------------------------------
+def seal_private(box: Box, text: str) -> str:
+    """Cifra ``text`` com Box e devolve o blob de send_blob (nonce + ciphertext em base64)."""
+    logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
+    logger.debug("  └─ Plaintext: %d bytes", len(text.encode()))
+
+    enc = box.encrypt(text.encode())
+    nonce, ct = enc.nonce, enc.ciphertext
+
+    logger.debug("  └─ Nonce gerado: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
+    logger.debug("  └─ Ciphertext: %d bytes (msg + 16 bytes MAC)", len(ct))
+    logger.debug("  └─ ✅ Mensagem criptografada com sucesso")
+
+    return b64(bytes(enc))
+
+def open_private(box, m: dict) -> tuple:
+    """Decifra uma mensagem privada com o Box do remetente; devolve (ts, remetente, texto)."""
+    if box is None:
+        logger.debug("  └─ ❌ Chave do remetente %s (kid %s) não está em cache", m["from"], m.get("kid"))
+        return (m["ts"], m["from"], "<chave do remetente desconhecida>")
+    blob_combined = ub64(m["blob"])
+    nonce = blob_combined[:Box.NONCE_SIZE]
+    ct = blob_combined[Box.NONCE_SIZE:]
+
+    logger.debug("")
+    logger.debug("[client.py][DECRYPT][PRIVADA] Descriptografando mensagem privada")
+    logger.debug("  └─ Arquivo: client.py | Função: open_private()")
+    logger.debug("  └─ Remetente: %s", m['from'])
+    logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
+    logger.debug("  └─ Nonce: %s", hex_preview(nonce))
+    logger.debug("  └─ Ciphertext: %d bytes", len(ct))
+
+    try:
+        pt = box.decrypt(blob_combined)
+        logger.debug("  └─ ✅ Descriptografia bem-sucedida")
+        logger.debug("  └─ Plaintext: %d bytes", len(pt))
+        return (m["ts"], m["from"], pt.decode())
+    except Exception as e:
+        logger.debug("  └─ ❌ Falha na descriptografia: %s", e)
+        return (m["ts"], m["from"], "<erro ao decifrar>")
+
+def seal_group(group_box: SecretBox, text: str) -> str:
+    """Cifra ``text`` com a chave do grupo e devolve o blob de send_group_blob."""
+    logger.debug("  └─ Algoritmo: XSalsa20-Poly1305 (SecretBox)")
+    logger.debug("  └─ Plaintext: %d bytes", len(text.encode()))
+
+    enc = group_box.encrypt(text.encode())
+    nonce, ct = enc.nonce, enc.ciphertext
+
+    logger.debug("  └─ Nonce gerado: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
+    logger.debug("  └─ Ciphertext: %d bytes (msg + 16 bytes MAC)", len(ct))
+    logger.debug("  └─ ✅ Mensagem criptografada com sucesso")
+
+    return b64(bytes(enc))
+
+def open_group(group_box: SecretBox, m: dict) -> tuple:
+    """Decifra uma mensagem de grupo recebida; devolve (ts, remetente, texto)."""
+    raw = ub64(m["blob"])
+    nonce = raw[:SecretBox.NONCE_SIZE]
+    ct = raw[SecretBox.NONCE_SIZE:]
+
+    logger.debug("")
+    logger.debug("[client.py][DECRYPT][GRUPO] Descriptografando mensagem de grupo")
+    logger.debug("  └─ Arquivo: client.py | Função: open_group()")
+    logger.debug("  └─ Remetente: %s", m['from'])
+    logger.debug("  └─ Algoritmo: XSalsa20-Poly1305 (SecretBox)")
+    logger.debug("  └─ Nonce: %s", hex_preview(nonce))
+    logger.debug("  └─ Ciphertext: %d bytes", len(ct))
+
+    try:
+        pt = group_box.decrypt(raw)
+        logger.debug("  └─ ✅ Descriptografia bem-sucedida")
+        logger.debug("  └─ Plaintext: %d bytes | Preview: %s", len(pt), pt[:30])
+        return (m["ts"], m["from"], pt.decode())
+    except Exception as e:
+        logger.debug("  └─ ❌ Falha na descriptografia: %s", e)
+        return (m["ts"], m["from"], "<erro ao decifrar>")
+
+FETCH_BATCH = 200  # mensagens por fetch_blobs
+
 class TLSSocketClient:
     def __init__(self, host, port, cafile=None, debug=False):
         self.host = host
@@ -92,10 +189,354 @@ class TLSSocketClient:
         except Exception as e:
             return {"status": "error", "reason": f"Erro de conexão: {e}"}
 
-async def interactive(server_host, server_port, cacert, client_id, debug):
+    async def close(self):
+        # conexões são abertas e fechadas a cada pedido
+        pass
+
+class WebSocketClient:
+    """Mesma interface do TLSSocketClient, mas sobre uma única conexão wss persistente."""
+
+    def __init__(self, host, port, cafile=None, debug=False):
+        self.host = host
+        self.port = port
+        self.cafile = cafile
+        self.debug = debug
+        self.ws = None
+        self.lock = asyncio.Lock()  # um pedido em voo por vez na conexão
+        self.on_push = None  # callback para frames enviados pelo servidor (ex.: presença)
+
+    def _sslctx(self):
+        sslctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        if self.cafile:
+            sslctx.load_verify_locations(self.cafile)
+        else:
+            # APENAS PARA DESENVOLVIMENTO
+            sslctx.check_hostname = False
+            sslctx.verify_mode = ssl.CERT_NONE
+            if self.debug:
+                logger.debug("[client.py][WEBSOCKET] Conectando SEM verificação (DEV ONLY)")
+        return sslctx
+
+    async def _connect(self):
+        if self.debug:
+            logger.debug("")
+            logger.debug("[client.py][WEBSOCKET] Abrindo conexão wss persistente")
+            logger.debug("  └─ Arquivo: client.py | Classe: WebSocketClient | Método: _connect()")
+            logger.debug("  └─ Compressão: permessage-deflate | Frames: binários")
+        self.ws = await websockets.connect(
+            f"wss://{self.host}:{self.port}/", ssl=self._sslctx(), compression="deflate"
+        )
+
+    async def send_recv(self, obj):
+        async with self.lock:
+            try:
+                if self.ws is None:
+                    await self._connect()
+                await self.ws.send(json.dumps(obj).encode())
+                while True:
+                    resp = json.loads(await self.ws.recv())
+                    if "status" in resp:
+                        return resp
+                    # frame de push intercalado com a resposta
+                    if self.on_push:
+                        self.on_push(resp)
+            except json.JSONDecodeError:
+                return {"status": "error", "reason": "O servidor enviou uma resposta inválida."}
+            except ConnectionRefusedError:
+                self.ws = None
+                return {"status": "error", "reason": "A conexão foi recusada. O servidor está offline?"}
+            except Exception as e:
+                # conexão caiu: a próxima chamada reconecta
+                self.ws = None
+                return {"status": "error", "reason": f"Erro de conexão: {e}"}
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws = None
+
+
+class AsyncStdin:
+    """Lê linhas do stdin pelo próprio event loop, sem uma thread por leitura."""
+
+    def __init__(self):
+        self.fd = sys.stdin.fileno()
+        self.buf = b""
+        # epoll recusa arquivos regulares (EPERM); stdin redirecionado de um
+        # arquivo nunca bloqueia, então é lido direto, sem add_reader
+        mode = os.fstat(self.fd).st_mode
+        self.pollable = stat.S_ISCHR(mode) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+    async def readline(self):
+        loop = asyncio.get_running_loop()
+        while b"\n" not in self.buf:
+            if self.pollable:
+                ready = loop.create_future()
+                try:
+                    loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(None))
+                except NotImplementedError:
+                    # event loop sem add_reader (Windows): volta ao input() numa thread
+                    return await asyncio.to_thread(input)
+                except OSError:
+                    self.pollable = False
+                    continue
+                try:
+                    await ready
+                finally:
+                    loop.remove_reader(self.fd)
+            chunk = os.read(self.fd, 4096)
+            if not chunk:
+                if not self.buf:
+                    raise EOFError
+                self.buf += b"\n"  # última linha sem quebra
+            self.buf += chunk
+        line, _, self.buf = self.buf.partition(b"\n")
+        return line.decode(errors="replace")
+
+
+class ChatView:
+    """Tela de conversa em curses que desenha só a janela visível do histórico.
+
+    ``history`` é a própria lista da conversa, então mensagens que chegam
+    aparecem ao vivo via notify(). ``entry_at(i)`` devolve (ts, remetente,
+    texto) e decifra a entrada apenas quando ela entra na janela.
+    """
+
+    HINT = "PgUp/PgDn/↑/↓: rolar | Enter: enviar | /quit: sair"
+
+    def __init__(self, title, history, entry_at, send):
+        self.title = title
+        self.history = history
+        self.entry_at = entry_at
+        self.send = send
+        self.offset = 0  # quantas entradas acima do fim estão ocultas
+        self.page = 1
+        self.text = ""
+        self.status = self.HINT
+        self.wake = asyncio.Event()
+
+    @staticmethod
+    def available():
+        return curses is not None and sys.stdin.isatty() and sys.stdout.isatty()
+
+    def notify(self, status=None):
+        if status:
+            self.status = status
+        self.wake.set()
+
+    def draw(self, scr):
+        height, width = scr.getmaxyx()
+        rows = max(1, height - 3)  # título, status e linha de entrada
+        self.page = rows
+        scr.erase()
+        scr.addnstr(0, 0, f" {self.title} ".ljust(width), width - 1, curses.A_REVERSE)
+
+        lines = []
+        i = len(self.history) - 1 - self.offset
+        while i >= 0 and len(lines) < rows:
+            ts, sender, text = self.entry_at(i)
+            lines[:0] = textwrap.wrap(f"[{ts}] {sender}: {text}", max(1, width - 1)) or [""]
+            i -= 1
+        for y, line in enumerate(lines[-rows:], start=1):
+            scr.addnstr(y, 0, line, width - 1)
+
+        scr.addnstr(height - 2, 0, self.status, width - 1, curses.A_DIM)
+        scr.addnstr(height - 1, 0, ("> " + self.text)[-(width - 1):], width - 1)
+        scr.refresh()
+
+    async def handle_key(self, key):
+        """Processa uma tecla; devolve False para sair da conversa."""
+        if key in ("\n", "\r", curses.KEY_ENTER):
+            text, self.text = self.text.strip(), ""
+            if text == "/quit":
+                return False
+            if text:
+                await self.send(text)
+                self.offset = 0
+            self.status = self.HINT
+        elif key in (curses.KEY_BACKSPACE, "\x7f", "\b"):
+            self.text = self.text[:-1]
+        elif key == curses.KEY_PPAGE:
+            self.offset = min(self.offset + self.page, max(0, len(self.history) - 1))
+        elif key == curses.KEY_NPAGE:
+            self.offset = max(0, self.offset - self.page)
+        elif key == curses.KEY_UP:
+            self.offset = min(self.offset + 1, max(0, len(self.history) - 1))
+        elif key == curses.KEY_DOWN:
+            self.offset = max(0, self.offset - 1)
+        elif isinstance(key, str) and key.isprintable():
+            self.text += key
+        return True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        fd = sys.stdin.fileno()
+        # logs no stderr corromperiam a tela enquanto o curses está ativo
+        logging.disable(logging.CRITICAL)
+        scr = curses.initscr()
+        try:
+            curses.noecho()
+            curses.cbreak()
+            scr.keypad(True)
+            scr.nodelay(True)
+            loop.add_reader(fd, self.wake.set)
+            while True:
+                self.draw(scr)
+                await self.wake.wait()
+                self.wake.clear()
+                while True:
+                    try:
+                        key = scr.get_wch()
+                    except curses.error:
+                        break  # nada mais a ler
+                    if not await self.handle_key(key):
+                        return
+        finally:
+            loop.remove_reader(fd)
+            scr.keypad(False)
+            curses.nocbreak()
+            curses.echo()
+            curses.endwin()
+            logging.disable(logging.NOTSET)
+
+
+class Inbox:
+    """Conversas do cliente e o processamento de cada lote de fetch_blobs.
+
+    O servidor marca cada mensagem com ``type`` (private, group ou group_key),
+    então ingest() despacha por dict, sem decodificar o blob. Mensagens
+    privadas trazem só o ``kid`` do remetente; o Box correspondente fica em
+    cache por (remetente, kid) e é criado uma única vez por chave. O ``kid``
+    só vale junto com o ``from`` que o publicou: um kid de outro peer não abre
+    a mensagem.
+    """
+
+    def __init__(self, priv):
+        self.priv = priv
+        self.conversations = {}  # peer_id -> [ (timestamp, sender, mensagem) ]
+        self.groups = {}         # group_id -> { "key": bytes, "history": [] }
+        self.boxes = {}          # (peer_id, kid) -> Box(priv, chave do peer)
+        self.peer_kids = {}      # peer_id -> kid da chave mais recente
+        self.on_new = lambda peer: None  # nova mensagem numa conversa
+        self.on_notice = lambda text: print("\n" + text)
+        self.handlers = {
+            "private": self._private,
+            "group": self._group,
+            "group_key": self._group_key,
+        }
+
+    def learn(self, peer, pub: bytes) -> Box:
+        """Registra a chave pública de ``peer`` e devolve o Box (em cache) para ela."""
+        kid = key_id(pub)
+        box = self.boxes.get((peer, kid))
+        if box is None:
+            box = self.boxes[peer, kid] = Box(self.priv, PublicKey(pub))
+        self.peer_kids[peer] = kid
+        return box
+
+    def _box_key(self, m):
+        sender = m["from"]
+        return sender, m.get("kid") or self.peer_kids.get(sender)
+
+    def box_for(self, m):
+        """Box para abrir ``m``, ou None se o kid não for uma chave conhecida do remetente."""
+        return self.boxes.get(self._box_key(m))
+
+    def missing_senders(self, messages):
+        """Remetentes cujo kid neste lote não bate com uma chave já obtida deles."""
+        return {
+            m["from"] for m in messages
+            if m.get("type") != "group" and self._box_key(m) not in self.boxes
+        }
+
+    def ingest(self, messages):
+        handlers = self.handlers
+        for m in messages:
+            m["ts"] = time.strftime("%H:%M:%S")  # horário de recebimento
+            handler = handlers.get(m.get("type"))
+            if handler is None:
+                logger.debug("Mensagem de tipo desconhecido ignorada: %s", m.get("type"))
+                continue
+            handler(m)
+
+    def _group(self, m):
+        group_id = m["group_id"]
+        if group_id not in self.groups:
+            self.groups[group_id] = {"key": None, "history": []}
+
+        if logger.isEnabledFor(logging.DEBUG):
+            raw = ub64(m["blob"])
+            logger.debug("")
+            logger.debug("[client.py][RECV][GRUPO] Mensagem de grupo recebida (cifrada)")
+            logger.debug("  └─ Arquivo: client.py | Classe: Inbox | Método: _group()")
+            logger.debug("  └─ Grupo: %s", group_id)
+            logger.debug("  └─ Remetente: %s", m["from"])
+            logger.debug("  └─ Algoritmo: XSalsa20-Poly1305 (AEAD)")
+            logger.debug("  └─ Nonce: %d bytes | Hex: %s", SecretBox.NONCE_SIZE, hex_preview(raw[:SecretBox.NONCE_SIZE]))
+            logger.debug("  └─ Ciphertext: %d bytes (inclui 16 bytes de MAC Poly1305)", len(raw) - SecretBox.NONCE_SIZE)
+            logger.debug("  └─ Status: Aguardando descriptografia pelo destinatário")
+
+        self.groups[group_id]["history"].append(("received_group", m))
+        self.on_new(group_id)
+
+    def _group_key(self, m):
+        group_id = m["group_id"]
+        logger.debug("")
+        logger.debug("[client.py][RECV] Distribuição de chave de grupo")
+        logger.debug("  └─ Arquivo: client.py | Classe: Inbox | Método: _group_key()")
+        logger.debug("  └─ Remetente: %s | kid: %s", m["from"], m.get("kid"))
+
+        box = self.box_for(m)
+        if box is None:
+            logger.debug("  └─ ❌ Chave do remetente desconhecida; distribuição descartada")
+            return
+
+        key_blob_combined = ub64(m["blob"])
+        logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
+        logger.debug("  └─ Nonce: %d bytes | Hex: %s", Box.NONCE_SIZE, hex_preview(key_blob_combined[:Box.NONCE_SIZE]))
+        logger.debug("  └─ Ciphertext: %d bytes", len(key_blob_combined) - Box.NONCE_SIZE)
+        logger.debug("  └─ Descriptografando chave simétrica do grupo...")
+
+        try:
+            group_key = box.decrypt(key_blob_combined)
+        except CryptoError as e:
+            logger.debug("  └─ ❌ Falha na descriptografia: %s", e)
+            return
+
+        if group_id not in self.groups:
+            self.groups[group_id] = {"history": []}
+        self.groups[group_id]["key"] = group_key
+
+        logger.debug("  └─ ✅ Chave de grupo obtida: %d bytes", len(group_key))
+        logger.debug("  └─ Grupo ID: %s", group_id)
+        logger.debug("  └─ Esta chave será usada para criptografia simétrica no grupo")
+
+        self.on_notice(f"🔑 Você foi adicionado ao grupo '{group_id}' e recebeu a chave simétrica.")
+
+    def _private(self, m):
+        peer = m["from"]
+        if logger.isEnabledFor(logging.DEBUG):
+            raw = ub64(m["blob"])
+            logger.debug("")
+            logger.debug("[client.py][RECV][PRIVADA] Mensagem privada recebida (cifrada)")
+            logger.debug("  └─ Arquivo: client.py | Classe: Inbox | Método: _private()")
+            logger.debug("  └─ Remetente: %s | kid: %s", peer, m.get("kid"))
+            logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
+            logger.debug("  └─ Nonce: %d bytes | Hex: %s", Box.NONCE_SIZE, hex_preview(raw[:Box.NONCE_SIZE]))
+            logger.debug("  └─ Ciphertext: %d bytes (inclui 16 bytes de MAC Poly1305)", len(raw) - Box.NONCE_SIZE)
+            logger.debug("  └─ Status: Aguardando descriptografia pelo destinatário")
+
+        if peer not in self.conversations:
+            self.conversations[peer] = []
+        self.conversations[peer].append(("received", m))
+        self.on_new(peer)
+
+
+async def interactive(server_host, server_port, cacert, client_id, debug, transport="tls"):
     setup_logging(debug)
     client_id = client_id.strip().strip('"')
-    client = TLSSocketClient(server_host, server_port, cacert, debug)
+    client_cls = WebSocketClient if transport == "ws" else TLSSocketClient
+    client = client_cls(server_host, server_port, cacert, debug)
 
     logger.info("")
     logger.info("=" * 70)
@@ -129,107 +570,76 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
     logger.info("  └─ ✅ Chave publicada com sucesso!")
     print(f"✅ Conectado como: {client_id}")
 
-    conversations = {}  # peer_id -> [ (timestamp, sender, mensagem) ]
-    groups = {}         # group_id -> { "key": bytes, "history": [] }
+    kid = key_id(pub)
+    inbox = Inbox(priv)
+    conversations = inbox.conversations
+    groups = inbox.groups
     new_msgs = {}       # peer_id -> int (novas mensagens)
 
+    stdin = AsyncStdin()
+    open_view = {"peer": None, "view": None}  # conversa aberta na ChatView
+
     async def ainput(prompt=""):
-        return await asyncio.to_thread(input, prompt)
+        print(prompt, end="", flush=True)
+        return await stdin.readline()
+
+    def notify_new(peer):
+        if open_view["peer"] == peer:
+            open_view["view"].notify()
+        else:
+            new_msgs[peer] = new_msgs.get(peer, 0) + 1
+
+    def notice(text):
+        if open_view["view"] is not None:
+            open_view["view"].notify(text)
+        else:
+            print("\n" + text)
+
+    inbox.on_new = notify_new
+    inbox.on_notice = notice
+
+    async def peer_box(peer):
+        """Busca a chave pública de ``peer`` no servidor e devolve o Box em cache (ou None)."""
+        resp = await client.send_recv({"type": "get_key", "client_id": peer})
+        if resp.get("status") != "ok":
+            return None
+        return inbox.learn(peer, ub64(resp["pubkey"]))
 
     async def poll_blobs():
         while True:
+            remaining = 0
             try:
+                # lotes limitados: chaves de grupo (faixa de controle) chegam no
+                # primeiro lote mesmo com um backlog grande
                 response = await client.send_recv(
-                    {"type": "fetch_blobs", "client_id": client_id}
+                    {"type": "fetch_blobs", "client_id": client_id, "limit": FETCH_BATCH}
                 )
+                remaining = response.get("remaining", 0)
                 if response.get("status") == "ok":
-                    for m in response.get("messages", []):
-                        if m.get("type") == "group":
-                            group_id = m["group_id"]
-                            if group_id not in groups:
-                                groups[group_id] = {"key": None, "history": []}
-
-                            raw = ub64(m["blob"])
-                            nonce = raw[:SecretBox.NONCE_SIZE]
-                            ct = raw[SecretBox.NONCE_SIZE:]
-
-                            logger.debug("")
-                            logger.debug("[client.py][RECV][GRUPO] Mensagem de grupo recebida (cifrada)")
-                            logger.debug("  └─ Arquivo: client.py | Função: poll_blobs()")
-                            logger.debug("  └─ Grupo: %s", group_id)
-                            logger.debug("  └─ Remetente: %s", m["from"])
-                            logger.debug("  └─ Algoritmo: XSalsa20-Poly1305 (AEAD)")
-                            logger.debug("  └─ Nonce: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
-                            logger.debug("  └─ Ciphertext: %d bytes (inclui 16 bytes de MAC Poly1305)", len(ct))
-                            logger.debug("  └─ Status: Aguardando descriptografia pelo destinatário")
-
-                            groups[group_id]["history"].append(("received_group", m))
-                            new_msgs[group_id] = new_msgs.get(group_id, 0) + 1
-                        else:
-                            # Pode ser distribuição de chave de grupo
-                            try:
-                                env = json.loads(base64.b64decode(m["blob"]).decode())
-                                if env.get("type") == "group_key_distribution":
-                                    logger.debug("")
-                                    logger.debug("[client.py][RECV] Distribuição de chave de grupo")
-                                    logger.debug("  └─ Arquivo: client.py | Função: poll_blobs()")
-
-                                    peer_pub_b64 = env["sender_pub"]
-                                    peer_pub = PublicKey(ub64(peer_pub_b64))
-                                    box = Box(priv, peer_pub)
-
-                                    key_blob_combined = ub64(env["key_blob"])
-                                    nonce = key_blob_combined[:Box.NONCE_SIZE]
-                                    ct = key_blob_combined[Box.NONCE_SIZE:]
-
-                                    logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
-                                    logger.debug("  └─ Nonce: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
-                                    logger.debug("  └─ Ciphertext: %d bytes", len(ct))
-                                    logger.debug("  └─ Descriptografando chave simétrica do grupo...")
-
-                                    group_key = box.decrypt(key_blob_combined)
-                                    group_id = env["group_id"]
-
-                                    if group_id not in groups:
-                                        groups[group_id] = {"history": []}
-                                    groups[group_id]["key"] = group_key
-
-                                    logger.debug("  └─ ✅ Chave de grupo obtida: %d bytes", len(group_key))
-                                    logger.debug("  └─ Grupo ID: %s", group_id)
-                                    logger.debug("  └─ Esta chave será usada para criptografia simétrica no grupo")
-
-                                    print(f"\n🔑 Você foi adicionado ao grupo '{group_id}' e recebeu a chave simétrica.")
-                                    continue
-                            except Exception as e:
-                                logger.debug("Envelope não era chave de grupo: %s", e)
-
-                            # Mensagem privada (cifrada) recebida
-                            peer = m["from"]
-                            raw = base64.b64decode(m["blob"])
-                            try:
-                                env = json.loads(raw.decode())
-                                blob_combined = ub64(env["blob"])
-                                nonce = blob_combined[:Box.NONCE_SIZE]
-                                ct = blob_combined[Box.NONCE_SIZE:]
-
-                                logger.debug("")
-                                logger.debug("[client.py][RECV][PRIVADA] Mensagem privada recebida (cifrada)")
-                                logger.debug("  └─ Arquivo: client.py | Função: poll_blobs()")
-                                logger.debug("  └─ Remetente: %s", peer)
-                                logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
-                                logger.debug("  └─ Nonce: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
-                                logger.debug("  └─ Ciphertext: %d bytes (inclui 16 bytes de MAC Poly1305)", len(ct))
-                                logger.debug("  └─ Status: Aguardando descriptografia pelo destinatário")
-                            except Exception:
-                                pass
-
-                            if peer not in conversations:
-                                conversations[peer] = []
-                            conversations[peer].append(("received", m))
-                            new_msgs[peer] = new_msgs.get(peer, 0) + 1
+                    messages = response.get("messages", [])
+                    # uma consulta por remetente novo (ou com kid que não bate com o
+                    # do cache, p.ex. após trocar de chave); o resto do lote usa o cache
+                    for peer in inbox.missing_senders(messages):
+                        await peer_box(peer)
+                    inbox.ingest(messages)
             except Exception as e:
                 logger.error("Erro no polling: %s", e)
-            await asyncio.sleep(1)
+            if not remaining:
+                await asyncio.sleep(1)
+
+    def on_push(frame):
+        if frame.get("type") != "presence":
+            return
+        notices = [f"🟢 {peer} está online" for peer in frame.get("online", [])]
+        notices += [f"⚪ {peer} ficou offline" for peer in frame.get("offline", [])]
+        if open_view["view"] is not None:
+            open_view["view"].notify(" | ".join(notices))
+        else:
+            for notice in notices:
+                print("\n" + notice)
+
+    if isinstance(client, WebSocketClient):
+        client.on_push = on_push
 
     poll_task = asyncio.create_task(poll_blobs())
 
@@ -241,6 +651,7 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
         print("  • Iniciar chat <cliente>        → Inicia conversa privada")
         print("  • Criar grupo <nome> com <...>  → Cria grupo com membros")
         print("  • Conversas                     → Entra em chats ativos")
+        print("  • Presença <cliente> [...]      → Avisa quando ficam on/offline (ws)")
         print("  • Sair                          → Encerra o cliente")
         print("=" * 70)
 
@@ -264,6 +675,20 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
             except Exception as e:
                 print("❌ Erro:", e)
 
+        elif cmd in ("presença", "presenca"):
+            peers = line.strip().split()[1:]
+            if not peers:
+                print("❌ Uso: Presença <cliente1> <cliente2>...")
+                continue
+            if not isinstance(client, WebSocketClient):
+                print("❌ Presença requer conexão persistente: use --transport ws")
+                continue
+            resp = await client.send_recv({"type": "subscribe_presence", "ids": peers})
+            if resp.get("status") == "ok":
+                print("🟢 Online agora:", resp.get("online", []))
+            else:
+                print(f"❌ Erro ao assinar presença: {resp.get('reason', 'causa desconhecida')}")
+
         elif cmd == "criar" and len(parts) > 1 and parts[1].lower() == "grupo":
             # parsing de múltiplos membros
             try:
@@ -310,14 +735,11 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
                     continue
 
                 # obter chave pública do membro
-                resp = await client.send_recv({"type": "get_key", "client_id": member})
-                if resp.get("status") != "ok":
-                    print(f"  ❌ Erro ao obter chave de {member}: {resp.get('reason')}")
+                box = await peer_box(member)
+                if box is None:
+                    print(f"  ❌ Erro ao obter chave de {member}")
                     continue
 
-                peer_pub = PublicKey(ub64(resp["pubkey"]))
-                box = Box(priv, peer_pub)
-
                 logger.debug("")
                 logger.debug("[client.py][ENCRYPT] Criptografando chave de grupo para membro")
                 logger.debug("  └─ Arquivo: client.py | Função: interactive() | Lógica: distribuir_chave_grupo")
@@ -333,17 +755,15 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
                 logger.debug("  └─ Ciphertext: %d bytes (chave + 16 bytes de MAC Poly1305)", len(ct))
                 logger.debug("  └─ ✅ Chave cifrada com sucesso para %s", member)
 
-                envelope = {
-                    "type": "group_key_distribution",
-                    "group_id": group_id,
-                    "sender_pub": b64(pub),
-                    "key_blob": b64(bytes(enc)),
-                }
+                # group_key vai na faixa de controle do servidor
                 payload = {
                     "type": "send_blob",
+                    "kind": "group_key",
                     "to": member,
                     "from": client_id,
-                    "blob": b64(json.dumps(envelope).encode()),
+                    "kid": kid,
+                    "group_id": group_id,
+                    "blob": b64(bytes(enc)),
                 }
                 await client.send_recv(payload)
                 print(f"  ✅ Chave enviada para {member}")
@@ -378,150 +798,103 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
                     continue
 
                 group_box = SecretBox(group["key"])
-                print(f"\n{'=' * 70}")
-                print(f"💬 Conversa em Grupo: {peer}")
-                print(f"{'=' * 70}")
-                print("Digite /quit para sair\n")
+                history = group["history"]
+                title = f"💬 Conversa em Grupo: {peer}"
 
-                # histórico
-                for entry in group["history"]:
-                    ts = time.strftime("%H:%M:%S")
-                    if entry[0] == "received_group":
-                        m = entry[1]
-                        raw = ub64(m["blob"])
-                        nonce = raw[:SecretBox.NONCE_SIZE]
-                        ct = raw[SecretBox.NONCE_SIZE:]
-
-                        logger.debug("")
-                        logger.debug("[client.py][DECRYPT][GRUPO] Descriptografando mensagem de grupo")
-                        logger.debug("  └─ Arquivo: client.py | Função: interactive() | Lógica: exibir_historico_grupo")
-                        logger.debug("  └─ Remetente: %s", m['from'])
-                        logger.debug("  └─ Algoritmo: XSalsa20-Poly1305 (SecretBox)")
-                        logger.debug("  └─ Nonce: %s", hex_preview(nonce))
-                        logger.debug("  └─ Ciphertext: %d bytes", len(ct))
-
-                        try:
-                            pt = group_box.decrypt(raw)
-                            logger.debug("  └─ ✅ Descriptografia bem-sucedida")
-                            logger.debug("  └─ Plaintext: %d bytes | Preview: %s", len(pt), pt[:30])
-                            print(f"[{ts}] {m['from']}: {pt.decode()}")
-                        except Exception as e:
-                            logger.debug("  └─ ❌ Falha na descriptografia: %s", e)
-                            print(f"[{ts}] {m['from']}: <erro ao decifrar>")
-                    else:
-                        ts, sender, msg = entry
-                        print(f"[{ts}] {sender}: {msg}")
-
-                # loop do chat
-                while True:
-                    text = await ainput("")
-                    if text.strip() == "/quit":
-                        print(f"👋 Saindo da conversa com {peer}.\n")
-                        break
+                def open_entry(m, group_box=group_box):
+                    return open_group(group_box, m), True
 
+                async def send(text, group_box=group_box, history=history, peer=peer):
                     ts = time.strftime("%H:%M:%S")
 
                     logger.debug("")
                     logger.debug("[client.py][ENCRYPT][GRUPO] Criptografando mensagem para grupo")
                     logger.debug("  └─ Arquivo: client.py | Função: interactive() | Lógica: enviar_msg_grupo")
                     logger.debug("  └─ Grupo: %s", peer)
-                    logger.debug("  └─ Algoritmo: XSalsa20-Poly1305 (SecretBox)")
-                    logger.debug("  └─ Plaintext: %d bytes", len(text.encode()))
-
-                    enc = group_box.encrypt(text.encode())
-                    nonce, ct = enc.nonce, enc.ciphertext
-
-                    logger.debug("  └─ Nonce gerado: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
-                    logger.debug("  └─ Ciphertext: %d bytes (msg + 16 bytes MAC)", len(ct))
-                    logger.debug("  └─ ✅ Mensagem criptografada com sucesso")
 
                     payload = {
                         "type": "send_group_blob",
                         "group_id": peer,
                         "from": client_id,
-                        "blob": b64(bytes(enc)),
+                        "blob": seal_group(group_box, text),
                     }
                     await client.send_recv(payload)
-                    group["history"].append((ts, client_id, text))
-                    print(f"[{ts}] {client_id}: {text}")
-                continue
+                    history.append((ts, client_id, text))
+                    return ts
 
             # ------------------------- Privado -------------------------
-            resp = await client.send_recv({"type": "get_key", "client_id": peer})
-            if resp.get("status") != "ok":
-                print("❌ Não foi possível obter chave do peer:", resp)
-                continue
+            else:
+                box = await peer_box(peer)
+                if box is None:
+                    print(f"❌ Não foi possível obter chave de {peer}")
+                    continue
+
+                history = conversations[peer]
+                title = f"💬 Conversa Privada com: {peer}"
+
+                def open_entry(m):
+                    # sem a chave do remetente (p.ex. get_key falhou) o resultado
+                    # não é definitivo: tenta de novo depois de peer_box()
+                    box = inbox.box_for(m)
+                    return open_private(box, m), box is not None
+
+                async def send(text, box=box, history=history, peer=peer):
+                    ts = time.strftime("%H:%M:%S")
+
+                    logger.debug("")
+                    logger.debug("[client.py][ENCRYPT][PRIVADA] Criptografando mensagem privada")
+                    logger.debug("  └─ Arquivo: client.py | Função: interactive() | Lógica: enviar_msg_privada")
+                    logger.debug("  └─ Destinatário: %s", peer)
 
-            peer_pub = PublicKey(ub64(resp["pubkey"]))
-            box = Box(priv, peer_pub)
+                    payload = {
+                        "type": "send_blob",
+                        "kind": "private",
+                        "to": peer,
+                        "from": client_id,
+                        "kid": kid,
+                        "blob": seal_private(box, text),
+                    }
+                    await client.send_recv(payload)
+                    history.append((ts, client_id, text))
+                    return ts
+
+            def entry_at(i, history=history, open_entry=open_entry):
+                # decifra sob demanda e memoriza no próprio histórico; o que ainda
+                # não tem chave continua cifrado e é tentado na próxima exibição
+                entry = history[i]
+                if entry[0] in ("received", "received_group"):
+                    opened, final = open_entry(entry[1])
+                    if final:
+                        history[i] = opened
+                    return opened
+                return entry
+
+            if ChatView.available():
+                view = ChatView(title, history, entry_at, send)
+                open_view.update(peer=peer, view=view)
+                try:
+                    await view.run()
+                finally:
+                    open_view.update(peer=None, view=None)
+                    new_msgs[peer] = 0
+                continue
 
+            # sem terminal interativo: modo texto simples
             print(f"\n{'=' * 70}")
-            print(f"💬 Conversa Privada com: {peer}")
+            print(title)
             print(f"{'=' * 70}")
             print("Digite /quit para sair\n")
 
-            for entry in conversations[peer]:
-                ts = time.strftime("%H:%M:%S")
-                if entry[0] == "received":
-                    m = entry[1]
-                    env = json.loads(base64.b64decode(m["blob"]).decode())
-                    blob_combined = ub64(env["blob"])
-                    nonce = blob_combined[:Box.NONCE_SIZE]
-                    ct = blob_combined[Box.NONCE_SIZE:]
-
-                    logger.debug("")
-                    logger.debug("[client.py][DECRYPT][PRIVADA] Descriptografando mensagem privada")
-                    logger.debug("  └─ Arquivo: client.py | Função: interactive() | Lógica: exibir_historico_privado")
-                    logger.debug("  └─ Remetente: %s", m['from'])
-                    logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
-                    logger.debug("  └─ Nonce: %s", hex_preview(nonce))
-                    logger.debug("  └─ Ciphertext: %d bytes", len(ct))
-
-                    sender_pub = PublicKey(ub64(env["sender_pub"]))
-                    msg_box = Box(priv, sender_pub)
-                    try:
-                        pt = msg_box.decrypt(blob_combined)
-                        logger.debug("  └─ ✅ Descriptografia bem-sucedida")
-                        logger.debug("  └─ Plaintext: %d bytes", len(pt))
-                        print(f"[{ts}] {m['from']}: {pt.decode()}")
-                    except Exception as e:
-                        logger.debug("  └─ ❌ Falha na descriptografia: %s", e)
-                        print(f"[{ts}] {m['from']}: <erro ao decifrar>")
-                else:
-                    ts, sender, msg = entry
-                    print(f"[{ts}] {sender}: {msg}")
+            for i in range(len(history)):
+                ts, sender, msg = entry_at(i)
+                print(f"[{ts}] {sender}: {msg}")
 
             while True:
                 text = await ainput("")
                 if text.strip() == "/quit":
                     print(f"👋 Saindo da conversa com {peer}.\n")
                     break
-
-                ts = time.strftime("%H:%M:%S")
-
-                logger.debug("")
-                logger.debug("[client.py][ENCRYPT][PRIVADA] Criptografando mensagem privada")
-                logger.debug("  └─ Arquivo: client.py | Função: interactive() | Lógica: enviar_msg_privada")
-                logger.debug("  └─ Destinatário: %s", peer)
-                logger.debug("  └─ Algoritmo: NaCl Box (X25519 + XSalsa20-Poly1305)")
-                logger.debug("  └─ Plaintext: %d bytes", len(text.encode()))
-
-                enc = box.encrypt(text.encode())
-                nonce, ct = enc.nonce, enc.ciphertext
-
-                logger.debug("  └─ Nonce gerado: %d bytes | Hex: %s", len(nonce), hex_preview(nonce))
-                logger.debug("  └─ Ciphertext: %d bytes (msg + 16 bytes MAC)", len(ct))
-                logger.debug("  └─ ✅ Mensagem criptografada com sucesso")
-
-                envelope = {"sender_pub": b64(pub), "blob": b64(bytes(enc))}
-                payload = {
-                    "type": "send_blob",
-                    "to": peer,
-                    "from": client_id,
-                    "blob": b64(json.dumps(envelope).encode()),
-                }
-                await client.send_recv(payload)
-                conversations[peer].append((ts, client_id, text))
+                ts = await send(text)
                 print(f"[{ts}] {client_id}: {text}")
 
         elif cmd == "iniciar":
@@ -539,6 +912,7 @@ async def interactive(server_host, server_port, cacert, client_id, debug):
         elif cmd == "sair":
             print("\n👋 Encerrando cliente...")
             poll_task.cancel()
+            await client.close()
             break
         else:
             print("❌ Comando desconhecido.")
@@ -550,6 +924,8 @@ if __name__ == "__main__":
     p.add_argument("--cacert", help="Certificado CA para verificação TLS")
     p.add_argument("--id", required=True, help="ID do cliente")
     p.add_argument("--debug", action="store_true", help="Ativa logs detalhados de criptografia e hash")
+    p.add_argument("--transport", choices=["tls", "ws"], default="tls",
+                   help="Transporte: socket TLS (padrão) ou WebSocket wss")
     args = p.parse_args()
 
     print("\n" + "=" * 70)
@@ -568,4 +944,4 @@ if __name__ == "__main__":
         print("=" * 70)
 
     host, port = args.server.split(":")
-    asyncio.run(interactive(host, int(port), args.cacert, args.id, args.debug))
\ No newline at end of file
+    asyncio.run(interactive(host, int(port), args.cacert, args.id, args.debug, args.transport))
\ No newline at end of file
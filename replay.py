@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Reproduz um trace gravado com ``server.py --capture`` contra um servidor.
+
+Cada conexão capturada vira uma conexão própria no mesmo transporte em que
+foi gravada (TLS em --server, WebSocket em --ws-server, com frames de texto
+ou binários como no original), e os comandos são reenviados na mesma ordem e
+com o mesmo espaçamento, dividido por --speed (0 = o mais rápido possível).
+No fim, compara a latência observada com a latência gravada no servidor e
+mostra o atraso de agendamento (drift).
+"""
+import argparse
+import asyncio
+import json
+import ssl
+import sys
+import time
+from collections import defaultdict
+
+import websockets
+
+
+def load_trace(path):
+    conns = defaultdict(list)  # (execução, conn_id) -> [registro]
+    run = -1
+    with open(path) as f:
+        for line in f:
+            rec = json.loads(line)
+            if "capture" in rec:
+                # traces antigos acumulavam várias execuções; conn_id recomeça em cada uma
+                run += 1
+                continue
+            conns[run, rec["c"]].append(rec)
+    return conns
+
+
+def transport_of(records):
+    return records[0].get("x", "tls")  # traces antigos não gravavam x
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+# --- Conexões (uma classe por transporte, como as sessões do servidor) ---
+class TLSConn:
+    def __init__(self, addr, sslctx):
+        self.addr = addr
+        self.sslctx = sslctx
+        self.writer = None
+
+    async def open(self):
+        host, port = self.addr
+        self.reader, self.writer = await asyncio.open_connection(host, port, ssl=self.sslctx)
+
+    async def exchange(self, rec):
+        # JSON delimitado por nova linha; None sinaliza EOF
+        self.writer.write((json.dumps(rec["m"]) + "\n").encode())
+        await self.writer.drain()
+        return await self.reader.readline() or None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class WebSocketConn:
+    def __init__(self, addr, sslctx):
+        self.addr = addr
+        self.sslctx = sslctx
+        self.ws = None
+
+    async def open(self):
+        host, port = self.addr
+        # permessage-deflate como o servidor; respostas de fetch_blobs passam de 1 MiB
+        self.ws = await websockets.connect(f"wss://{host}:{port}", ssl=self.sslctx,
+                                           compression="deflate", max_size=None)
+
+    async def exchange(self, rec):
+        data = json.dumps(rec["m"])
+        try:
+            await self.ws.send(data.encode() if rec.get("b") else data)
+            return await self.ws.recv()
+        except websockets.ConnectionClosed:
+            return None
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+TRANSPORTS = {"tls": TLSConn, "websocket": WebSocketConn}
+
+
+async def replay_conn(records, conn, speed, t0, results):
+    opened = False
+    try:
+        for rec in records:
+            target = t0 + (rec["t"] / speed if speed else 0)
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not opened:
+                await conn.open()
+                opened = True
+
+            issued = time.perf_counter()
+            line = await conn.exchange(rec)
+            done = time.perf_counter()
+
+            results.append({
+                "type": rec["m"].get("type"),
+                "latency": done - issued,
+                "captured": rec["l"],
+                "drift": max(0.0, issued - target) if speed else 0.0,
+                "ok": bool(line) and json.loads(line).get("status") == "ok",
+            })
+            if not line:
+                break
+    finally:
+        await conn.close()
+
+
+async def replay(conns, addrs, cafile, speed):
+    sslctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    if cafile:
+        sslctx.load_verify_locations(cafile)
+    else:
+        # APENAS PARA DESENVOLVIMENTO
+        sslctx.check_hostname = False
+        sslctx.verify_mode = ssl.CERT_NONE
+
+    results = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*(
+        replay_conn(records, TRANSPORTS[transport_of(records)](addrs[transport_of(records)], sslctx),
+                    speed, t0, results)
+        for records in conns.values()
+    ))
+    return results, time.perf_counter() - t0
+
+
+def report(results, elapsed):
+    by_type = defaultdict(list)
+    for r in results:
+        by_type[r["type"]].append(r)
+
+    print("=" * 70)
+    print(f"REPLAY: {len(results)} comandos em {elapsed:.2f}s ({len(results) / elapsed:.0f} cmd/s)")
+    print("=" * 70)
+    print(f"{'comando':<18}{'n':>7}{'p50 ms':>9}{'p99 ms':>9}{'cap p50':>9}{'cap p99':>9}{'erros':>7}")
+    for mtype, rs in sorted(by_type.items(), key=lambda kv: str(kv[0])):
+        lat = [r["latency"] * 1000 for r in rs]
+        cap = [r["captured"] * 1000 for r in rs]
+        errors = sum(not r["ok"] for r in rs)
+        print(f"{str(mtype):<18}{len(rs):>7}{percentile(lat, 50):>9.2f}{percentile(lat, 99):>9.2f}"
+              f"{percentile(cap, 50):>9.2f}{percentile(cap, 99):>9.2f}{errors:>7}")
+
+    drift = [r["drift"] * 1000 for r in results]
+    print("-" * 70)
+    print(f"Drift de agendamento: p50 {percentile(drift, 50):.2f} ms | "
+          f"p99 {percentile(drift, 99):.2f} ms | máx {max(drift, default=0):.2f} ms")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Replay de tráfego capturado - Chat Seguro")
+    p.add_argument("trace", help="Arquivo gerado por server.py --capture")
+    p.add_argument("--server", required=True, help="Endereço do servidor TLS (host:port)")
+    p.add_argument("--ws-server", help="Endereço do listener WebSocket (host:port), "
+                                       "exigido se o trace tiver sessões WebSocket")
+    p.add_argument("--cacert", help="Certificado CA para verificação TLS")
+    p.add_argument("--speed", default=1.0, type=float,
+                   help="Fator de aceleração (1, 10, ...); 0 = velocidade máxima")
+    p.add_argument("--json", help="Salva os resultados brutos neste arquivo")
+    args = p.parse_args()
+
+    addrs = {}
+    for transport, addr in (("tls", args.server), ("websocket", args.ws_server)):
+        if addr:
+            host, port = addr.rsplit(":", 1)
+            addrs[transport] = (host, int(port))
+    conns = load_trace(args.trace)
+    missing = {transport_of(records) for records in conns.values()} - addrs.keys()
+    if missing:
+        sys.exit(f"O trace tem sessões {', '.join(sorted(missing))}: informe --ws-server")
+    results, elapsed = asyncio.run(replay(conns, addrs, args.cacert, args.speed))
+    report(results, elapsed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"elapsed": elapsed, "speed": args.speed, "results": results}, f)
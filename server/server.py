@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
+import array
 import asyncio
+import base64
 import builtins
 import contextlib
+import gc
+import itertools
 import json
+import math
+import mmap
+import os
+import signal
 import ssl
 import logging
+import struct
+import sys
+import time
+import websockets
 from argparse import ArgumentParser
 from pathlib import Path
 
@@ -20,9 +32,37 @@ log = logging.getLogger("chatseguro.server")
 
 PUBKEYS_FILE = Path("pubkeys.json")
 PUBLIC_KEYS = {}  # client_id -> base64 pubkey
-BLOBS = {}  # recipient_id -> [ {from, blob(base64), meta} ]
-ACTIVE_CLIENTS = {}  # client_id -> {reader, writer}
+BLOBS = {}  # handle do destinatário -> Mailbox
+ACTIVE_CLIENTS = {}  # client_id -> {session}
+LAST_SEEN = {}  # client_id -> tick de PRESENCE_BUCKETS em que fica offline
+PRESENCE_WATCHERS = {}  # client_id -> {sessões inscritas na presença dele}
 GROUPS = {}  # group_id -> { "members": [client_id], "admin": client_id }
+STATS = {  # contadores expostos pelo comando "stats"
+    "blobs_expired": 0,
+    "blobs_rejected_unknown": 0,  # envios descartados para IDs sem chave (--reject-unknown)
+    "connections_open": 0,
+    "connections_shed": 0,
+    "connections_reaped": 0,
+}
+
+# --- Configuração (sobrescrita pelos argumentos de linha de comando) ---
+BLOB_TTL = 7 * 24 * 3600  # TTL padrão de mensagens não entregues (segundos)
+BLOB_TTL_MAX = 30 * 24 * 3600  # teto para o TTL pedido por mensagem
+BLOB_TTL_LIMIT = 10 * 365 * 24 * 3600  # maior valor aceito para os dois acima (ticks vão em u32)
+REJECT_UNKNOWN = False  # recusar envios para IDs sem chave pública
+IDLE_TIMEOUT = 300.0  # segundos sem nenhuma linha antes de derrubar a conexão
+WRITE_TIMEOUT = 30.0  # tempo máximo esperando o peer esvaziar o buffer
+MAX_CONNECTIONS = 10000  # conexões simultâneas antes de recusar novas
+LANE_WEIGHTS = (4, 1)  # entregas interativas por entregas bulk, após o controle
+PRESENCE_WINDOW = 0.25  # janela (s) para agrupar mudanças de presença num só frame
+PRESENCE_TIMEOUT = 10.0  # segundos sem publish_key/fetch_blobs até o cliente ficar offline
+DRAIN_TIMEOUT = 10.0  # tempo máximo (s) esperando pedidos em andamento no desligamento
+KID_CHARS = frozenset("0123456789abcdef")  # kid: 16 hex (blake2b de 8 bytes da chave pública)
+
+_CONN_SEQ = itertools.count()
+CAPTURE = None  # TrafficCapture ativo quando --capture é informado
+SESSIONS = set()  # sessões abertas, para o modo drain
+DRAINING = False
 
 
 # --- Inicialização do JSON ---
@@ -66,201 +106,1179 @@ def store_pubkey(client_id, pubkey_b64):
     log.info("  └─  Persistido em: pubkeys.json")
 
 
+# --- Representação compacta da caixa postal ---
+# Os handles são contados por referência: cada slot vivo do STORE segura o seu
+# destinatário, remetente e grupo, e cada caixa postal o seu destinatário. Um id
+# que não aparece mais em nenhum deles (p.ex. um destinatário inexistente cujas
+# mensagens expiraram) sai da tabela e o handle é reaproveitado.
+ID_NAMES = []  # handle -> client_id / group_id (None = livre)
+ID_HANDLES = {}  # client_id / group_id -> handle
+ID_REFS = array.array("I")  # handle -> referências vivas
+ID_FREE = []  # handles livres para reuso
+
+
+def intern_id(name):
+    """Handle de ``name``; deve ser usado logo em seguida (enqueue_blob), senão fica sem dono."""
+    handle = ID_HANDLES.get(name)
+    if handle is None:
+        if ID_FREE:
+            handle = ID_FREE.pop()
+            ID_NAMES[handle] = name
+        else:
+            handle = len(ID_NAMES)
+            ID_NAMES.append(name)
+            ID_REFS.append(0)
+        ID_HANDLES[name] = handle
+    return handle
+
+
+def release_id(handle):
+    refs = ID_REFS[handle] - 1
+    ID_REFS[handle] = refs
+    if not refs:
+        del ID_HANDLES[ID_NAMES[handle]]
+        ID_NAMES[handle] = None
+        ID_FREE.append(handle)
+
+
+# Tipo de cada mensagem entregue; o cliente despacha por ele sem tentar decodificar.
+# "group_key" é a chave simétrica de um grupo cifrada com Box para um membro.
+KINDS = ("private", "group", "group_key")
+PRIVATE, GROUP, GROUP_KEY = range(len(KINDS))
+HAS_KID = 0x80  # bit na coluna kind: a mensagem traz kid
+
+LANES = ("control", "interactive", "bulk")
+CONTROL, INTERACTIVE, BULK = range(len(LANES))
+# o cliente só escolhe entre estas; control é reservada às distribuições de
+# chave (group_key), que o próprio servidor encaminha por ela
+CLIENT_LANES = ("interactive", "bulk")
+
+
+class MessageStore:
+    """Mensagens pendentes em colunas (array), sem nenhum objeto Python por mensagem.
+
+    Cada mensagem ocupa um slot: o índice comum a todas as colunas. Só o
+    ciphertext é um objeto (bytes crus, compartilhado entre os membros de um
+    grupo); o base64 e o dict do protocolo são montados em to_wire(), na
+    entrega. due == 0 marca slot morto (entregue ou expirado); slots mortos
+    voltam à lista livre quando saem da fila da caixa postal. Depois de
+    load_snapshot, ``blobs`` guarda para as mensagens restauradas um int: o
+    índice do ciphertext no snapshot mapeado (SNAPSHOT_BLOBS), lido só na entrega.
+    """
+
+    __slots__ = ("to", "sender", "group", "kid", "kind", "lane", "due", "blobs", "metas", "free")
+
+    def __init__(self):
+        self.to = array.array("I")      # handle do destinatário
+        self.sender = array.array("I")  # handle do remetente
+        self.group = array.array("i")   # handle do grupo, -1 se não houver
+        self.kid = array.array("Q")     # ID curto da chave do remetente (64 bits), fora da tabela de ids
+        self.kind = array.array("B")    # índice em KINDS | HAS_KID
+        self.lane = array.array("B")    # índice em LANES
+        self.due = array.array("I")     # tick absoluto de expiração; 0 = morto
+        self.blobs = []                 # ciphertext (bytes) ou índice em SNAPSHOT_BLOBS (int)
+        self.metas = {}                 # slot -> meta (raro)
+        self.free = array.array("I")    # slots reutilizáveis
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def add(self, to, sender, blob, kind, group, kid, meta, lane, due):
+        if kid < 0:
+            kid = 0
+        else:
+            kind |= HAS_KID
+        if self.free:
+            slot = self.free.pop()
+            self.to[slot] = to
+            self.sender[slot] = sender
+            self.group[slot] = group
+            self.kid[slot] = kid
+            self.kind[slot] = kind
+            self.lane[slot] = lane
+            self.due[slot] = due
+            self.blobs[slot] = blob
+        else:
+            slot = len(self.blobs)
+            self.to.append(to)
+            self.sender.append(sender)
+            self.group.append(group)
+            self.kid.append(kid)
+            self.kind.append(kind)
+            self.lane.append(lane)
+            self.due.append(due)
+            self.blobs.append(blob)
+        if meta:
+            self.metas[slot] = meta
+        refs = ID_REFS
+        refs[to] += 1
+        refs[sender] += 1
+        if group >= 0:
+            refs[group] += 1
+        return slot
+
+    def kill(self, slot):
+        self.due[slot] = 0
+        self.blobs[slot] = None
+        if self.metas:
+            self.metas.pop(slot, None)
+        release_id(self.to[slot])
+        release_id(self.sender[slot])
+        if self.group[slot] >= 0:
+            release_id(self.group[slot])
+
+    def blob(self, slot):
+        blob = self.blobs[slot]
+        return SNAPSHOT_BLOBS.get(blob) if blob.__class__ is int else blob
+
+    def to_wire(self, slot):
+        kind = self.kind[slot] & ~HAS_KID
+        obj = {
+            "type": KINDS[kind],
+            "from": ID_NAMES[self.sender[slot]],
+            "blob": base64.b64encode(self.blob(slot)).decode(),
+        }
+        if self.group[slot] >= 0:
+            obj["group_id"] = ID_NAMES[self.group[slot]]
+        if self.kind[slot] & HAS_KID:
+            obj["kid"] = format(self.kid[slot], "016x")
+        if kind == PRIVATE:
+            obj["meta"] = self.metas.get(slot) or {}
+        return obj
+
+
+STORE = MessageStore()
+
+
+class Mailbox:
+    """Fila de um destinatário separada em faixas de prioridade.
+
+    Cada faixa é um array de slots do STORE consumido a partir de ``heads``;
+    mensagens expiradas ficam como lápide (slot morto) até a entrega passar
+    por elas. Controle (ex.: distribuição de chave de grupo) sai sempre
+    primeiro; as faixas interativa e bulk são intercaladas segundo
+    LANE_WEIGHTS, para que um grande volume bulk não atrase o chat. A vez
+    (``turn``) no ciclo ponderado persiste entre chamadas de take(), então
+    mesmo lotes pequenos entregam bulk na proporção configurada.
+    """
+
+    __slots__ = ("lanes", "heads", "live", "turn")
+
+    def __init__(self, lanes=None, live=None):
+        self.lanes = lanes or [None, None, None]  # faixa -> array de slots (criado no primeiro uso)
+        self.heads = [0, 0, 0]                    # próxima posição a entregar em cada faixa
+        self.live = live or [0, 0, 0]             # mensagens vivas em cada faixa
+        self.turn = 0                             # posição no ciclo interativo:bulk
+
+    def __len__(self):
+        live = self.live
+        return live[0] + live[1] + live[2]
+
+    def push(self, lane, slot):
+        queue = self.lanes[lane]
+        if queue is None:
+            queue = self.lanes[lane] = array.array("I")
+        queue.append(slot)
+        self.live[lane] += 1
+
+    def pop_front(self, lane, n):
+        """Entrega até ``n`` mensagens vivas da faixa e libera os slots percorridos."""
+        queue = self.lanes[lane]
+        if queue is None or n <= 0:
+            return []
+        due, free, to_wire, kill = STORE.due, STORE.free, STORE.to_wire, STORE.kill
+        out = []
+        pos, end = self.heads[lane], len(queue)
+        while pos < end and len(out) < n:
+            slot = queue[pos]
+            pos += 1
+            if due[slot]:
+                out.append(to_wire(slot))
+                kill(slot)
+            free.append(slot)
+        self.live[lane] -= len(out)
+        if pos == end:
+            self.lanes[lane], pos = None, 0
+        elif pos > 1024 and pos * 2 > end:
+            del queue[:pos]  # compacta quando o prefixo consumido domina
+            pos = 0
+        self.heads[lane] = pos
+        return out
+
+    def release(self):
+        """Devolve à lista livre as lápides que restarem; chamada com a caixa vazia."""
+        for lane, queue in enumerate(self.lanes):
+            if queue is not None:
+                STORE.free.extend(queue[self.heads[lane]:])
+        self.lanes = [None, None, None]
+        self.heads = [0, 0, 0]
+
+    def take(self, limit=None):
+        """Retira até ``limit`` mensagens (todas, se None), já no formato do protocolo."""
+        budget = len(self) if limit is None else min(limit, len(self))
+        out = self.pop_front(CONTROL, budget)
+
+        # round-robin ponderado: as primeiras w_inter vezes do ciclo são da faixa
+        # interativa e as w_bulk seguintes da bulk; a vez de uma faixa vazia
+        # passa para a outra, sem acumular crédito
+        w_inter, w_bulk = LANE_WEIGHTS
+        cycle = w_inter + w_bulk
+        left_inter, left_bulk = self.live[INTERACTIVE], self.live[BULK]
+        turn = self.turn % cycle
+        order = []
+        for _ in range(budget - len(out)):
+            if (turn < w_inter and left_inter) or not left_bulk:
+                order.append(INTERACTIVE)
+                left_inter -= 1
+            else:
+                order.append(BULK)
+                left_bulk -= 1
+            turn = (turn + 1) % cycle
+        self.turn = turn
+
+        n_bulk = order.count(BULK)
+        inter = iter(self.pop_front(INTERACTIVE, len(order) - n_bulk))
+        bulk = iter(self.pop_front(BULK, n_bulk))
+        out += [next(bulk) if lane == BULK else next(inter) for lane in order]
+        return out
+
+
+def resolve_lane(msg):
+    priority = msg.get("priority")
+    if priority is None:
+        return INTERACTIVE
+    return LANES.index(priority) if priority in CLIENT_LANES else None
+
+
+def resolve_kind(msg):
+    """Tipo declarado em send_blob; "group" só é produzido por send_group_blob."""
+    kind = msg.get("kind", "private")
+    return KINDS.index(kind) if kind in KINDS and kind != "group" else None
+
+
+def resolve_kid(msg):
+    kid = msg.get("kid")
+    if kid is None:
+        return -1
+    if not isinstance(kid, str) or len(kid) != 16 or not KID_CHARS.issuperset(kid):
+        return None
+    return int(kid, 16)
+
+
+def decode_blob(blob):
+    try:
+        return base64.b64decode(blob, validate=True)
+    except Exception:
+        return None
+
+
+# --- Expiração de mensagens ---
+class ExpiryBuckets:
+    """Varredor de expiração por baldes: agendar e expirar custam O(1) amortizado.
+
+    Cada balde é um array com os slots que vencem num tick absoluto; a cada
+    tick só o balde corrente é retirado, então BLOBS nunca é varrido por
+    completo. Um slot já entregue (ou reutilizado) é reconhecido por STORE.due
+    diferente do tick do balde. A presença usa a mesma estrutura com baldes de
+    client_id (``new_bucket=list``).
+    """
+
+    def __init__(self, tick=1.0, new_bucket=lambda: array.array("I")):
+        self.buckets = {}  # tick absoluto -> array de slots
+        self.tick = tick
+        self.now = 0
+        self.new_bucket = new_bucket
+
+    def due(self, ttl):
+        # o tick vai numa coluna u32 do STORE e do snapshot
+        return min(self.now + max(1, math.ceil(ttl / self.tick)), 0xFFFFFFFF)
+
+    def schedule(self, due, slot):
+        bucket = self.buckets.get(due)
+        if bucket is None:
+            bucket = self.buckets[due] = self.new_bucket()
+        bucket.append(slot)
+
+    def advance(self):
+        """Avança um tick e devolve os slots agendados para ele."""
+        self.now += 1
+        return self.buckets.pop(self.now, ())
+
+
+EXPIRY_BUCKETS = ExpiryBuckets()
+PRESENCE_BUCKETS = ExpiryBuckets(new_bucket=list)  # client_id agendados para ficar offline
+
+
+def enqueue_blob(to, sender, blob, ttl, kind=PRIVATE, group=-1, kid=-1, meta=None, lane=INTERACTIVE):
+    # to, sender e group são handles internados; kid é o inteiro do hex, -1 se não houver
+    due = EXPIRY_BUCKETS.due(ttl)
+    slot = STORE.add(to, sender, blob, kind, group, kid, meta, lane, due)
+    mailbox = BLOBS.get(to)
+    if mailbox is None:
+        mailbox = BLOBS[to] = Mailbox()
+        ID_REFS[to] += 1
+    mailbox.push(lane, slot)
+    EXPIRY_BUCKETS.schedule(due, slot)
+
+
+def drop_mailbox(to, mailbox):
+    """Remove a caixa vazia de ``to`` e solta o handle que ela segurava."""
+    mailbox.release()
+    del BLOBS[to]
+    release_id(to)
+
+
+def expire_due():
+    expired = 0
+    now = EXPIRY_BUCKETS.now + 1
+    due = STORE.due
+    for slot in EXPIRY_BUCKETS.advance():
+        if due[slot] != now:
+            continue  # já entregue, ou slot reutilizado por outra mensagem
+        to = STORE.to[slot]
+        mailbox = BLOBS[to]
+        mailbox.live[STORE.lane[slot]] -= 1
+        STORE.kill(slot)  # vira lápide; o slot é liberado quando a fila passar por ele
+        expired += 1
+        if not mailbox:
+            drop_mailbox(to, mailbox)
+    STATS["blobs_expired"] += expired
+    return expired
+
+
+async def expiry_sweeper():
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    ticks = 0
+    while True:
+        await asyncio.sleep(EXPIRY_BUCKETS.tick)
+        # recupera ticks perdidos se o loop atrasou
+        expired = 0
+        while ticks < int((loop.time() - start) / EXPIRY_BUCKETS.tick):
+            ticks += 1
+            expired += expire_due()
+        if expired:
+            log.info("[server.py][EXPIRY] %d mensagem(ns) expirada(s) sem entrega", expired)
+
+
+def resolve_ttl(msg):
+    ttl = msg.get("ttl")
+    if ttl is None:
+        return BLOB_TTL
+    if not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or not 0 < ttl < math.inf:
+        return None  # o JSON aceita Infinity e NaN
+    return min(ttl, BLOB_TTL_MAX)
+
+
+# --- Captura de tráfego (para replay com replay.py) ---
+def scrub_blob(blob):
+    """Troca o ciphertext por bytes aleatórios do mesmo tamanho."""
+    try:
+        size = len(base64.b64decode(blob, validate=True))
+    except Exception:
+        return base64.b64encode(os.urandom(len(blob)))[:len(blob)].decode()
+    return base64.b64encode(os.urandom(size)).decode()
+
+
+class TrafficCapture:
+    """Grava o fluxo de comandos em JSON lines com chaves curtas.
+
+    Cada linha: t (chegada do pedido, s desde o início), c (conexão), x (transporte),
+    b (1 se o frame WebSocket era binário), q/r (bytes do pedido/resposta),
+    l (latência no servidor, s) e m (o comando, com blobs substituídos por
+    ruído de mesmo tamanho).
+    Cada execução sobrescreve o arquivo: conn_id recomeça do zero a cada processo.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "w", buffering=1 << 16)
+        self.start = time.perf_counter()
+        self.flushed = self.start
+        self.records = 0
+        self.file.write(json.dumps({"capture": 1, "started": time.time()}) + "\n")
+
+    def record(self, session, msg, req_size, resp_size, started, latency):
+        if isinstance(msg.get("blob"), str):
+            msg = {**msg, "blob": scrub_blob(msg["blob"])}
+        line = {
+            "t": round(started - self.start, 6),
+            "c": session.conn_id,
+            "x": session.transport,
+            "q": req_size,
+            "r": resp_size,
+            "l": round(latency, 6),
+            "m": msg,
+        }
+        if getattr(session, "binary", False):
+            line["b"] = 1
+        self.file.write(json.dumps(line, separators=(",", ":")) + "\n")
+        self.records += 1
+        # descarrega no máximo uma vez por segundo para não perder o trace num kill
+        now = time.perf_counter()
+        if now - self.flushed > 1.0:
+            self.file.flush()
+            self.flushed = now
+
+    def close(self):
+        self.file.close()
+
+
 # --- Respostas ---
-async def send_ok(writer, payload):
-    obj = {"status": "ok", **payload}
-    writer.write((json.dumps(obj) + "\n").encode())
-    await writer.drain()
+def ok(payload):
+    return {"status": "ok", **payload}
 
 
-async def send_error(writer, reason):
-    obj = {"status": "error", "reason": reason}
-    writer.write((json.dumps(obj) + "\n").encode())
-    await writer.drain()
+def error(reason):
+    return {"status": "error", "reason": reason}
 
 
-# --- Handler de conexões ---
-async def handle_reader(reader, writer):
-    addr = writer.get_extra_info("peername")
-    client_id = None
-    log.info("")
-    log.info("[server.py][TLS] Nova conexão TLS estabelecida")
-    log.info("  └─ Arquivo: server.py | Função: handle_reader()")
-    log.info("  └─ Endereço remoto: %s", addr)
-    log.info("  └─ Protocolo: TLS (Transport Layer Security)")
+# --- Sessões (uma por conexão, independente do transporte) ---
+class TLSSession:
+    transport = "tls"
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+        self.conn_id = next(_CONN_SEQ)
+        self.client_id = None
+        self.closing = False
+        self.busy = False  # processando um pedido
+        self.subscriptions = set()  # IDs cuja presença esta sessão acompanha
+
+    async def recv(self):
+        # JSON delimitado por nova linha; None sinaliza EOF
+        return await self.reader.readline() or None
+
+    async def send(self, obj):
+        data = (json.dumps(obj) + "\n").encode()
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), WRITE_TIMEOUT)
+        return len(data)
+
+    async def close(self):
+        self.writer.close()
+        with contextlib.suppress(builtins.BaseException):
+            await self.writer.wait_closed()
+
+
+class WebSocketSession:
+    transport = "websocket"
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.addr = ws.remote_address
+        self.conn_id = next(_CONN_SEQ)
+        self.client_id = None
+        self.closing = False
+        self.busy = False  # processando um pedido
+        self.subscriptions = set()  # IDs cuja presença esta sessão acompanha
+        self.binary = False  # responde no mesmo tipo de frame do último pedido
+
+    async def recv(self):
+        try:
+            frame = await self.ws.recv()
+        except websockets.ConnectionClosed:
+            return None
+        self.binary = isinstance(frame, bytes)
+        return frame
+
+    async def send(self, obj):
+        data = json.dumps(obj).encode()
+        await asyncio.wait_for(self.ws.send(data if self.binary else data.decode()), WRITE_TIMEOUT)
+        return len(data)
+
+    async def close(self):
+        with contextlib.suppress(builtins.BaseException):
+            await self.ws.close()
+
+
+def unregister_client(client_id, session):
+    # só remove se o registro ainda aponta para esta conexão
+    entry = ACTIVE_CLIENTS.get(client_id)
+    if entry is not None and entry["session"] is session:
+        del ACTIVE_CLIENTS[client_id]
+        return True
+    return False
+
+
+# --- Presença ---
+_presence_pending = {}  # client_id -> estado (online?) antes da janela atual
+_presence_timer = None
+_background_tasks = set()
+
+
+def is_online(client_id):
+    # conexão persistente registrada, ou pedido recente de um cliente TLS que
+    # abre uma conexão por pedido (o presence_reaper remove os vencidos)
+    return client_id in ACTIVE_CLIENTS or client_id in LAST_SEEN
+
+
+def touch(client_id):
+    """Renova o last-seen de ``client_id``; avisa a presença se ele estava offline."""
+    was_online = is_online(client_id)
+    # +1: o tick corrente já começou, e o cliente não deve cair antes do timeout
+    due = PRESENCE_BUCKETS.due(PRESENCE_TIMEOUT) + 1
+    if LAST_SEEN.get(client_id) != due:
+        LAST_SEEN[client_id] = due
+        PRESENCE_BUCKETS.schedule(due, client_id)
+    if not was_online:
+        presence_changed(client_id, False)
+
+
+def expire_presence():
+    """Tira do LAST_SEEN só os clientes agendados para o tick corrente."""
+    now = PRESENCE_BUCKETS.now + 1
+    for client_id in PRESENCE_BUCKETS.advance():
+        if LAST_SEEN.get(client_id) != now:
+            continue  # renovado depois, ou já desconectado
+        del LAST_SEEN[client_id]
+        if client_id not in ACTIVE_CLIENTS:
+            presence_changed(client_id, True)
+
+
+async def presence_reaper():
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    ticks = 0
+    while True:
+        await asyncio.sleep(PRESENCE_BUCKETS.tick)
+        # recupera ticks perdidos se o loop atrasou
+        while ticks < int((loop.time() - start) / PRESENCE_BUCKETS.tick):
+            ticks += 1
+            expire_presence()
+
 
+def presence_changed(client_id, was_online):
+    global _presence_timer
+    if client_id not in PRESENCE_WATCHERS:
+        return
+    _presence_pending.setdefault(client_id, was_online)
+    if _presence_timer is None:
+        _presence_timer = asyncio.get_running_loop().call_later(PRESENCE_WINDOW, flush_presence)
+
+
+def flush_presence():
+    """Envia um único frame por sessão com todas as mudanças da janela."""
+    global _presence_pending, _presence_timer
+    pending, _presence_pending, _presence_timer = _presence_pending, {}, None
+
+    batches = {}  # sessão -> {"online": [...], "offline": [...]}
+    for client_id, was_online in pending.items():
+        online = is_online(client_id)
+        if online == was_online:
+            continue  # caiu e voltou dentro da janela
+        for session in PRESENCE_WATCHERS.get(client_id, ()):
+            delta = batches.setdefault(session, {"online": [], "offline": []})
+            delta["online" if online else "offline"].append(client_id)
+
+    for session, delta in batches.items():
+        task = asyncio.create_task(push(session, {"type": "presence", **delta}))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def push(session, obj):
+    try:
+        await session.send(obj)
+    except Exception as e:
+        log.debug("[server.py][PUSH] Falha ao enviar para %s: %s", session.addr, e)
+
+
+def unsubscribe(session, ids):
+    for client_id in ids:
+        watchers = PRESENCE_WATCHERS.get(client_id)
+        if watchers is not None:
+            watchers.discard(session)
+            if not watchers:
+                del PRESENCE_WATCHERS[client_id]
+    session.subscriptions.difference_update(ids)
+
+
+# --- Motor de comandos ---
+async def handle_command(session, msg):
+    """Executa um comando do protocolo e devolve o objeto de resposta."""
+    if not isinstance(msg, dict):
+        return error("invalid json: esperado um objeto")
+
+    mtype = msg.get("type")
+
+    if mtype == "publish_key":
+        cid = msg.get("client_id")
+        pub = msg.get("pubkey")
+        if not cid or not pub:
+            return error("publish_key requer client_id e pubkey")
+
+        store_pubkey(cid, pub)
+
+        if cid not in ACTIVE_CLIENTS:
+            log.info("[server.py][LOGIN] Cliente conectado: %s", cid)
+        touch(cid)
+        ACTIVE_CLIENTS[cid] = {"session": session}
+
+        session.client_id = cid
+        return ok({"message": "key stored", "client_id": cid})
+
+    elif mtype == "get_key":
+        cid = msg.get("client_id")
+        if not cid:
+            return error("get_key requer client_id")
+
+        pub = PUBLIC_KEYS.get(cid)
+        if not pub:
+            return error("não encontrado")
+        else:
+            log.info("")
+            log.info("[server.py][PUBKEY_FETCH] Chave pública solicitada")
+            log.info("  └─ Arquivo: server.py | Função: handle_command() | Comando: get_key")
+            log.info("  └─ Cliente solicitado: %s", cid)
+            log.info("  └─ Tamanho (base64): %d caracteres", len(pub))
+            log.info("  └─ ✅ Chave enviada ao solicitante")
+            return ok({"client_id": cid, "pubkey": pub})
+
+    elif mtype == "send_blob":
+        to = msg.get("to")
+        frm = msg.get("from")
+        blob = msg.get("blob")
+        meta = msg.get("meta", {})
+        if not to or not frm or not blob:
+            return error("send_blob requer to, from e blob")
+        kind = resolve_kind(msg)
+        if kind is None:
+            return error("kind deve ser private ou group_key")
+        group_id = msg.get("group_id")
+        if kind == GROUP_KEY and not group_id:
+            return error("kind group_key requer group_id")
+        kid = resolve_kid(msg)
+        if kid is None:
+            return error("kid deve ter 16 caracteres hexadecimais minúsculos")
+        raw = decode_blob(blob)
+        if raw is None:
+            return error("blob deve estar em base64")
+        ttl = resolve_ttl(msg)
+        if ttl is None:
+            return error("ttl deve ser um número positivo")
+        if REJECT_UNKNOWN and to not in PUBLIC_KEYS:
+            STATS["blobs_rejected_unknown"] += 1
+            return error("destinatário desconhecido")
+        lane = resolve_lane(msg)
+        if lane is None:
+            return error(f"priority deve ser uma de: {', '.join(CLIENT_LANES)}")
+        if kind == GROUP_KEY:
+            lane = CONTROL  # distribuição de chave destrava o grupo
+        group = intern_id(group_id) if kind == GROUP_KEY else -1
+        enqueue_blob(intern_id(to), intern_id(frm), raw, ttl, kind, group, kid, meta or None, lane)
+
+        log.info("")
+        log.info("[server.py][TRANSPORTE][MSG_PRIVADA] Mensagem criptografada em trânsito")
+        log.info("  └─ Arquivo: server.py | Função: handle_command() | Comando: send_blob")
+        log.info("  └─ Remetente: %s", frm)
+        log.info("  └─ Destinatário: %s", to)
+        log.info("  └─ Tamanho do blob (base64): %d caracteres", len(blob))
+        log.info("  └─ Tipo: %s | TTL: %ds | Prioridade: %s", KINDS[kind], ttl, LANES[lane])
+        log.info("  └─ ⚠️  IMPORTANTE: Servidor NÃO decripta. Apenas transporta!")
+        log.info("  └─ Criptografia aplicada: NaCl Box (X25519 + XSalsa20-Poly1305)")
+        log.info("  └─ Autenticação: Poly1305 MAC (16 bytes)")
+        log.info("  └─ A descriptografia ocorre no cliente destino")
+
+        return ok({"message": "stored"})
+
+    elif mtype == "create_group":
+        group_id = msg.get("group_id")
+        members = msg.get("members")
+        admin = msg.get("admin")
+        if not group_id or not members or not admin:
+            return error("create_group requer group_id, members e admin")
+        if group_id in GROUPS:
+            return error("grupo já existe")
+        if REJECT_UNKNOWN:
+            unknown = [m for m in members if m not in PUBLIC_KEYS]
+            if unknown:
+                return error(f"membros desconhecidos: {', '.join(unknown)}")
+
+        GROUPS[group_id] = {"members": members, "admin": admin}
+
+        log.info("")
+        log.info("[server.py][GRUPO][CREATE] Novo grupo criado")
+        log.info("  └─ Arquivo: server.py | Função: handle_command() | Comando: create_group")
+        log.info("  └─ ID do grupo: %s", group_id)
+        log.info("  └─ Administrador: %s", admin)
+        log.info("  └─ Membros: %s", ", ".join(members))
+        log.info("  └─ Total de membros: %d", len(members))
+
+        return ok({"message": "group created"})
+
+    elif mtype == "send_group_blob":
+        group_id = msg.get("group_id")
+        frm = msg.get("from")
+        blob = msg.get("blob")
+        if not group_id or not frm or not blob:
+            return error("send_group_blob requer group_id, from e blob")
+        if group_id not in GROUPS:
+            return error("grupo não encontrado")
+
+        group = GROUPS[group_id]
+        if frm not in group["members"]:
+            return error("você não é membro deste grupo")
+        ttl = resolve_ttl(msg)
+        if ttl is None:
+            return error("ttl deve ser um número positivo")
+        raw = decode_blob(blob)
+        if raw is None:
+            return error("blob deve estar em base64")
+        lane = resolve_lane(msg)
+        if lane is None:
+            return error(f"priority deve ser uma de: {', '.join(CLIENT_LANES)}")
+
+        log.info("")
+        log.info("[server.py][TRANSPORTE][MSG_GRUPO] Mensagem de grupo em trânsito")
+        log.info("  └─ Arquivo: server.py | Função: handle_command() | Comando: send_group_blob")
+        log.info("  └─ Remetente: %s", frm)
+        log.info("  └─ Grupo: %s", group_id)
+        log.info("  └─ Tamanho do blob (base64): %d caracteres", len(blob))
+        log.info("  └─ Destinatários: %d membros", len(group["members"]) - 1)
+        log.info("  └─ ⚠️  IMPORTANTE: Servidor NÃO decripta. Apenas distribui!")
+        log.info("  └─ Criptografia aplicada: NaCl SecretBox (XSalsa20-Poly1305)")
+        log.info("  └─ Chave simétrica: Compartilhada entre membros do grupo")
+        log.info("  └─ Autenticação: Poly1305 MAC (16 bytes)")
+
+        # distribuir a mensagem para os outros membros; grupos criados antes de
+        # --reject-unknown (ou vindos de um snapshot) podem ter membros sem chave
+        recipients = []
+        for member in group["members"]:
+            if member == frm:
+                continue
+            if REJECT_UNKNOWN and member not in PUBLIC_KEYS:
+                STATS["blobs_rejected_unknown"] += 1
+                continue
+            recipients.append(member)
+        if recipients:  # sem destinatários, nada seguraria os handles
+            sender, ghandle = intern_id(frm), intern_id(group_id)
+            for member in recipients:
+                enqueue_blob(intern_id(member), sender, raw, ttl, GROUP, ghandle, lane=lane)
+        return ok({"message": "stored for group"})
+
+    elif mtype == "fetch_blobs":
+        cid = msg.get("client_id")
+        if not cid:
+            return error("fetch_blobs requer client_id")
+        limit = msg.get("limit")
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+            return error("limit deve ser um inteiro positivo")
+        touch(cid)  # o polling é o sinal de vida dos clientes TLS
+        handle = ID_HANDLES.get(cid)
+        mailbox = BLOBS.get(handle)
+        items, remaining = [], 0
+        if mailbox is not None:
+            items = mailbox.take(limit)
+            remaining = len(mailbox)
+            if not remaining:
+                drop_mailbox(handle, mailbox)
+
+        if items:
+            log.info("")
+            log.info("[server.py][FETCH] Mensagens pendentes entregues")
+            log.info("  └─ Arquivo: server.py | Função: handle_command() | Comando: fetch_blobs")
+            log.info("  └─ Cliente: %s", cid)
+            log.info("  └─ Quantidade de mensagens: %d | Restantes: %d", len(items), remaining)
+
+        return ok({"messages": items, "remaining": remaining})
+
+    elif mtype == "list_all":
+        requester = msg.get("client_id")
+        clients = [c for c in PUBLIC_KEYS if c != requester]
+        groups = list(GROUPS.keys())
+        return ok({"clients": clients, "groups": groups})
+
+    elif mtype == "subscribe_presence":
+        ids = msg.get("ids")
+        if not isinstance(ids, list) or not all(isinstance(c, str) for c in ids):
+            return error("subscribe_presence requer ids (lista de client_id)")
+        for cid in ids:
+            PRESENCE_WATCHERS.setdefault(cid, set()).add(session)
+        session.subscriptions.update(ids)
+        return ok({"online": [c for c in ids if is_online(c)], "timeout": PRESENCE_TIMEOUT})
+
+    elif mtype == "unsubscribe_presence":
+        ids = msg.get("ids")
+        if ids is not None and not isinstance(ids, list):
+            return error("unsubscribe_presence requer ids (lista de client_id)")
+        unsubscribe(session, list(session.subscriptions) if ids is None else ids)
+        return ok({"message": "unsubscribed"})
+
+    elif mtype == "ping":
+        return ok({"message": "pong"})
+
+    elif mtype == "stats":
+        by_lane = [0] * len(LANES)
+        for mailbox in BLOBS.values():
+            for i, live in enumerate(mailbox.live):
+                by_lane[i] += live
+        return ok({**STATS, "blobs_pending": sum(by_lane), "blobs_pending_by_lane": dict(zip(LANES, by_lane))})
+
+    elif mtype == "disconnect":
+        cid = msg.get("client_id")
+        if cid and is_online(cid):
+            ACTIVE_CLIENTS.pop(cid, None)
+            LAST_SEEN.pop(cid, None)
+            log.info("[server.py][LOGOUT] Cliente desconectado: %s", cid)
+            presence_changed(cid, True)
+            session.client_id = None
+        session.closing = True
+        return ok({"message": "disconnected"})
+
+    else:
+        return error("unknown_type")
+
+
+async def run_session(session):
+    if DRAINING:
+        with contextlib.suppress(Exception):
+            await session.send(error("servidor reiniciando, tente novamente"))
+        await session.close()
+        return
+
+    if STATS["connections_open"] >= MAX_CONNECTIONS:
+        STATS["connections_shed"] += 1
+        log.warning("[server.py][SHED] Limite de %d conexões atingido, recusando %s", MAX_CONNECTIONS, session.addr)
+        with contextlib.suppress(Exception):
+            await session.send(error("servidor sobrecarregado, tente novamente"))
+        await session.close()
+        return
+
+    STATS["connections_open"] += 1
+    SESSIONS.add(session)
     try:
-        while True:
-            line = await reader.readline()
-            if not line:
+        while not session.closing:
+            try:
+                frame = await asyncio.wait_for(session.recv(), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                STATS["connections_reaped"] += 1
+                log.info("[server.py][IDLE] Conexão ociosa por %.0fs encerrada: %s", IDLE_TIMEOUT, session.addr)
+                break
+            if frame is None:
                 break
             try:
-                msg = json.loads(line.decode())
+                msg = json.loads(frame)
             except Exception as e:
-                await send_error(writer, f"invalid json: {e}")
+                await session.send(error(f"invalid json: {e}"))
                 continue
 
-            mtype = msg.get("type")
+            started = time.perf_counter()
+            session.busy = True
+            try:
+                sent = await session.send(await handle_command(session, msg))
+            finally:
+                session.busy = False
+            if CAPTURE is not None and isinstance(msg, dict):
+                # frames WebSocket de texto chegam como str: mede em bytes, como a resposta
+                req_size = len(frame.encode()) if isinstance(frame, str) else len(frame)
+                CAPTURE.record(session, msg, req_size, sent, started, time.perf_counter() - started)
 
-            if mtype == "publish_key":
-                cid = msg.get("client_id")
-                pub = msg.get("pubkey")
-                if not cid or not pub:
-                    await send_error(writer, "publish_key requer client_id e pubkey")
-                    continue
+    except Exception as e:
+        log.error("[server.py][ERRO] Conexão encerrada com erro: %s", e)
+    finally:
+        STATS["connections_open"] -= 1
+        SESSIONS.discard(session)
+        if session.client_id and unregister_client(session.client_id, session):
+            log.info("[server.py][LOGOUT] Conexão de %s encerrada sem disconnect", session.client_id)
+            if session.transport == "websocket":
+                # WebSocket é persistente: fechar é sair. No TLS uma conexão
+                # por pedido é normal, e o last-seen decide até o timeout
+                LAST_SEEN.pop(session.client_id, None)
+            presence_changed(session.client_id, True)
+        unsubscribe(session, list(session.subscriptions))
+        await session.close()
+
+
+# --- Transportes ---
+async def handle_reader(reader, writer):
+    session = TLSSession(reader, writer)
+    log.info("")
+    log.info("[server.py][TLS] Nova conexão TLS estabelecida")
+    log.info("  └─ Arquivo: server.py | Função: handle_reader()")
+    log.info("  └─ Endereço remoto: %s", session.addr)
+    log.info("  └─ Protocolo: TLS (Transport Layer Security)")
+    await run_session(session)
+
+
+async def handle_websocket(ws):
+    session = WebSocketSession(ws)
+    log.info("")
+    log.info("[server.py][WEBSOCKET] Nova conexão WebSocket estabelecida")
+    log.info("  └─ Arquivo: server.py | Função: handle_websocket()")
+    log.info("  └─ Endereço remoto: %s", session.addr)
+    log.info("  └─ Protocolo: WebSocket sobre TLS (wss), permessage-deflate")
+    await run_session(session)
+
+
+# --- Snapshot do estado (reinício a quente) ---
+# Formato (little-endian); cada array é gravado como u32 n + n itens:
+#   magic | u32 len(cabeçalho) | cabeçalho JSON: ids vivos por handle, grupos, metas
+#   por slot e tick atual
+#   referências de cada handle (0 = livre)
+#   colunas do STORE: to, sender, group, kid, kind, lane, due, blob (índice na tabela, -1 = nenhum)
+#   lista livre do STORE
+#   tabela de blobs: array de n + 1 deslocamentos (u64) | bytes concatenados
+#   caixas postais: array de destinatários | 3 vivas por caixa | 3 tamanhos de fila por
+#   caixa | slots de todas as filas concatenados (caixa a caixa, faixa a faixa)
+#   u32 n_baldes | por balde: u32 tick, array de slots
+# As colunas são copiadas com frombytes, sem laço Python por mensagem; os ticks
+# são absolutos e o relógio de expiração continua de onde parou. Os blobs não
+# são copiados: o arquivo fica mapeado e cada um é lido na entrega.
+# Blobs de grupo aparecem uma única vez na tabela e são referenciados por índice.
+SNAPSHOT_MAGIC = b"CSSNAP\x00\x08"
+_SNAP_COLUMNS = ("to", "sender", "group", "kid", "kind", "lane", "due")
 
-                store_pubkey(cid, pub)
 
-                if cid not in ACTIVE_CLIENTS:
-                    log.info("[server.py][LOGIN] Cliente conectado: %s", cid)
-                    ACTIVE_CLIENTS[cid] = {"reader": reader, "writer": writer}
+class SnapshotBlobs:
+    """Tabela de blobs do snapshot carregado, lida do arquivo mapeado sob demanda.
 
-                client_id = cid
-                await send_ok(writer, {"message": "key stored", "client_id": cid})
+    O mapeamento vale até o fim do processo, mesmo com o arquivo já removido.
+    """
 
-            elif mtype == "get_key":
-                cid = msg.get("client_id")
-                if not cid:
-                    await send_error(writer, "get_key requer client_id")
-                    continue
+    __slots__ = ("mm", "base", "offsets")
 
-                pub = PUBLIC_KEYS.get(cid)
-                if not pub:
-                    await send_error(writer, "não encontrado")
+    def __init__(self, mm, base, offsets):
+        self.mm = mm
+        self.base = base
+        self.offsets = offsets
+
+    def get(self, idx):
+        base, offsets = self.base, self.offsets
+        return self.mm[base + offsets[idx]:base + offsets[idx + 1]]
+
+
+SNAPSHOT_BLOBS = None  # SnapshotBlobs do último load_snapshot
+
+
+def _write_array(f, arr):
+    if sys.byteorder == "big":
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    f.write(struct.pack("<I", len(arr)))
+    f.write(arr.tobytes())
+
+
+def _read_array(mm, off, typecode):
+    (n,) = struct.unpack_from("<I", mm, off)
+    off += 4
+    arr = array.array(typecode)
+    end = off + n * arr.itemsize
+    if end > len(mm):
+        raise ValueError("snapshot truncado")
+    arr.frombytes(mm[off:end])
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr, end
+
+
+def save_snapshot(path):
+    blob_index = {}  # id(bytes) -> posição na tabela de blobs
+    mapped_index = {}  # índice em SNAPSHOT_BLOBS -> posição na tabela de blobs
+    blobs = []
+    refs = array.array("i")
+    due = STORE.due
+    for slot, blob in enumerate(STORE.blobs):
+        if not due[slot]:
+            refs.append(-1)
+            continue
+        if blob.__class__ is int:
+            index, key = mapped_index, blob
+        else:
+            index, key = blob_index, id(blob)
+        idx = index.get(key)
+        if idx is None:
+            idx = index[key] = len(blobs)
+            blobs.append(STORE.blob(slot))
+        refs.append(idx)
+
+    header = {
+        "names": {handle: name for handle, name in enumerate(ID_NAMES) if name is not None},
+        "groups": GROUPS,
+        "metas": STORE.metas,
+        "now": EXPIRY_BUCKETS.now,
+    }
+    tmp = Path(f"{path}.tmp")
+    with tmp.open("wb") as f:
+        header_json = json.dumps(header).encode()
+        f.write(SNAPSHOT_MAGIC + struct.pack("<I", len(header_json)))
+        f.write(header_json)
+        _write_array(f, ID_REFS)
+        for name in _SNAP_COLUMNS:
+            _write_array(f, getattr(STORE, name))
+        _write_array(f, refs)
+        _write_array(f, STORE.free)
+        _write_array(f, array.array("Q", itertools.accumulate(map(len, blobs), initial=0)))
+        f.writelines(blobs)
+
+        lives, sizes, queues = array.array("I"), array.array("I"), array.array("I")
+        for mailbox in BLOBS.values():
+            lives.extend(mailbox.live)
+            for lane, queue in enumerate(mailbox.lanes):
+                if queue is None:
+                    sizes.append(0)
                 else:
-                    log.info("")
-                    log.info("[server.py][PUBKEY_FETCH] Chave pública solicitada")
-                    log.info("  └─ Arquivo: server.py | Função: handle_reader() | Comando: get_key")
-                    log.info("  └─ Cliente solicitado: %s", cid)
-                    log.info("  └─ Tamanho (base64): %d caracteres", len(pub))
-                    log.info("  └─ ✅ Chave enviada ao solicitante")
-                    await send_ok(writer, {"client_id": cid, "pubkey": pub})
-
-            elif mtype == "send_blob":
-                to = msg.get("to")
-                frm = msg.get("from")
-                blob = msg.get("blob")
-                meta = msg.get("meta", {})
-                if not to or not frm or not blob:
-                    await send_error(writer, "send_blob requer to, from e blob")
-                    continue
-                BLOBS.setdefault(to, []).append({"from": frm, "blob": blob, "meta": meta})
-
-                log.info("")
-                log.info("[server.py][TRANSPORTE][MSG_PRIVADA] Mensagem criptografada em trânsito")
-                log.info("  └─ Arquivo: server.py | Função: handle_reader() | Comando: send_blob")
-                log.info("  └─ Remetente: %s", frm)
-                log.info("  └─ Destinatário: %s", to)
-                log.info("  └─ Tamanho do blob (base64): %d caracteres", len(blob))
-                log.info("  └─ ⚠️  IMPORTANTE: Servidor NÃO decripta. Apenas transporta!")
-                log.info("  └─ Criptografia aplicada: NaCl Box (X25519 + XSalsa20-Poly1305)")
-                log.info("  └─ Autenticação: Poly1305 MAC (16 bytes)")
-                log.info("  └─ A descriptografia ocorre no cliente destino")
-
-                await send_ok(writer, {"message": "stored"})
-
-            elif mtype == "create_group":
-                group_id = msg.get("group_id")
-                members = msg.get("members")
-                admin = msg.get("admin")
-                if not group_id or not members or not admin:
-                    await send_error(writer, "create_group requer group_id, members e admin")
-                    continue
-                if group_id in GROUPS:
-                    await send_error(writer, "grupo já existe")
-                    continue
-
-                GROUPS[group_id] = {"members": members, "admin": admin}
-
-                log.info("")
-                log.info("[server.py][GRUPO][CREATE] Novo grupo criado")
-                log.info("  └─ Arquivo: server.py | Função: handle_reader() | Comando: create_group")
-                log.info("  └─ ID do grupo: %s", group_id)
-                log.info("  └─ Administrador: %s", admin)
-                log.info("  └─ Membros: %s", ", ".join(members))
-                log.info("  └─ Total de membros: %d", len(members))
-
-                await send_ok(writer, {"message": "group created"})
-
-            elif mtype == "send_group_blob":
-                group_id = msg.get("group_id")
-                frm = msg.get("from")
-                blob = msg.get("blob")
-                if not group_id or not frm or not blob:
-                    await send_error(writer, "send_group_blob requer group_id, from e blob")
-                    continue
-                if group_id not in GROUPS:
-                    await send_error(writer, "grupo não encontrado")
-                    continue
-
-                group = GROUPS[group_id]
-                if frm not in group["members"]:
-                    await send_error(writer, "você não é membro deste grupo")
-                    continue
-
-                log.info("")
-                log.info("[server.py][TRANSPORTE][MSG_GRUPO] Mensagem de grupo em trânsito")
-                log.info("  └─ Arquivo: server.py | Função: handle_reader() | Comando: send_group_blob")
-                log.info("  └─ Remetente: %s", frm)
-                log.info("  └─ Grupo: %s", group_id)
-                log.info("  └─ Tamanho do blob (base64): %d caracteres", len(blob))
-                log.info("  └─ Destinatários: %d membros", len(group["members"]) - 1)
-                log.info("  └─ ⚠️  IMPORTANTE: Servidor NÃO decripta. Apenas distribui!")
-                log.info("  └─ Criptografia aplicada: NaCl SecretBox (XSalsa20-Poly1305)")
-                log.info("  └─ Chave simétrica: Compartilhada entre membros do grupo")
-                log.info("  └─ Autenticação: Poly1305 MAC (16 bytes)")
-
-                # distribuir a mensagem para os outros membros
-                for member in group["members"]:
-                    if member != frm:
-                        BLOBS.setdefault(member, []).append(
-                            {"from": frm, "blob": blob, "group_id": group_id, "type": "group"}
-                        )
-                await send_ok(writer, {"message": "stored for group"})
-
-            elif mtype == "fetch_blobs":
-                cid = msg.get("client_id")
-                if not cid:
-                    await send_error(writer, "fetch_blobs requer client_id")
-                    continue
-                items = BLOBS.pop(cid, [])
-
-                if items:
-                    log.info("")
-                    log.info("[server.py][FETCH] Mensagens pendentes entregues")
-                    log.info("  └─ Arquivo: server.py | Função: handle_reader() | Comando: fetch_blobs")
-                    log.info("  └─ Cliente: %s", cid)
-                    log.info("  └─ Quantidade de mensagens: %d", len(items))
-
-                await send_ok(writer, {"messages": items})
-
-            elif mtype == "list_all":
-                requester = msg.get("client_id")
-                clients = [c for c in PUBLIC_KEYS if c != requester]
-                groups = list(GROUPS.keys())
-                await send_ok(writer, {"clients": clients, "groups": groups})
-
-            elif mtype == "disconnect":
-                cid = msg.get("client_id")
-                if cid and cid in ACTIVE_CLIENTS:
-                    del ACTIVE_CLIENTS[cid]
-                    log.info("[server.py][LOGOUT] Cliente desconectado: %s", cid)
-                await send_ok(writer, {"message": "disconnected"})
-                break
+                    queues.extend(queue[mailbox.heads[lane]:])
+                    sizes.append(len(queue) - mailbox.heads[lane])
+        _write_array(f, array.array("I", BLOBS.keys()))
+        _write_array(f, lives)
+        _write_array(f, sizes)
+        _write_array(f, queues)
+        count = sum(lives)
 
-            else:
-                await send_error(writer, "unknown_type")
+        # só os agendamentos ainda válidos; entregues e reutilizados ficam de fora
+        buckets = []
+        for tick, slots in EXPIRY_BUCKETS.buckets.items():
+            valid = array.array("I", [slot for slot in slots if due[slot] == tick])
+            if valid:
+                buckets.append((tick, valid))
+        f.write(struct.pack("<I", len(buckets)))
+        for tick, slots in buckets:
+            f.write(struct.pack("<I", tick))
+            _write_array(f, slots)
+    os.replace(tmp, path)
+    return count
 
+
+def load_snapshot(path):
+    """Carrega um snapshot via mmap; só deve ser chamada com o estado vazio.
+
+    O arquivo é lido por inteiro em objetos locais e conferido antes de tocar
+    no estado global: um snapshot truncado ou corrompido deixa o servidor vazio.
+    """
+    global SNAPSHOT_BLOBS
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # uma caixa por destinatário: centenas de milhares de listas novas
+    # disparariam o GC cíclico várias vezes; ao final vão para a geração
+    # permanente com gc.freeze()
+    gc.disable()
+    try:
+        if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("arquivo não é um snapshot do chat seguro")
+        off = len(SNAPSHOT_MAGIC)
+        (header_len,) = struct.unpack_from("<I", mm, off)
+        off += 4
+        header = json.loads(mm[off:off + header_len])
+        off += header_len
+
+        id_refs, off = _read_array(mm, off, "I")
+        names = [None] * len(id_refs)
+        for handle, name in header["names"].items():
+            names[int(handle)] = name
+        if any((name is None) != (not refs) for name, refs in zip(names, id_refs)):
+            raise ValueError("tabela de ids inconsistente")
+
+        columns = {}
+        for name in _SNAP_COLUMNS:
+            columns[name], off = _read_array(mm, off, getattr(STORE, name).typecode)
+        refs, off = _read_array(mm, off, "i")
+        free, off = _read_array(mm, off, "I")
+        n_slots = len(refs)
+        if any(len(column) != n_slots for column in columns.values()):
+            raise ValueError("colunas do snapshot com tamanhos diferentes")
+        if n_slots and max(max(columns[name]) for name in ("to", "sender", "group")) >= len(names):
+            raise ValueError("handle fora da tabela de ids")
+        metas = {int(slot): meta for slot, meta in header["metas"].items()}
+
+        offsets, off = _read_array(mm, off, "Q")
+        if not offsets or off + offsets[-1] > len(mm):
+            raise ValueError("tabela de blobs truncada")
+        if n_slots and max(refs) >= len(offsets) - 1:
+            raise ValueError("slot aponta para fora da tabela de blobs")
+        blobs = SnapshotBlobs(mm, off, offsets)
+        off += offsets[-1]
+
+        tos, off = _read_array(mm, off, "I")
+        lives, off = _read_array(mm, off, "I")
+        sizes, off = _read_array(mm, off, "I")
+        queues, off = _read_array(mm, off, "I")
+        if len(lives) != 3 * len(tos) or len(sizes) != 3 * len(tos) or sum(sizes) != len(queues):
+            raise ValueError("tabela de caixas postais inconsistente")
+        mailboxes = {}
+        pos = 0
+        for i, to in enumerate(tos):
+            j = 3 * i
+            lanes = [None, None, None]
+            for lane in range(3):
+                size = sizes[j + lane]
+                if size:
+                    lanes[lane] = queues[pos:pos + size]
+                    pos += size
+            mailboxes[to] = Mailbox(lanes, lives[j:j + 3].tolist())
+
+        (n_buckets,) = struct.unpack_from("<I", mm, off)
+        off += 4
+        buckets = {}
+        for _ in range(n_buckets):
+            (tick,) = struct.unpack_from("<I", mm, off)
+            buckets[tick], off = _read_array(mm, off + 4, "I")
+        if off != len(mm):
+            raise ValueError("bytes sobrando no fim do snapshot")
+        if any(slots and max(slots) >= n_slots for slots in (free, queues, *buckets.values())):
+            raise ValueError("slot fora do STORE")
+    except BaseException:
+        gc.enable()
+        mm.close()
+        raise
+
+    # tudo lido: instala no estado global (nada aqui pode falhar no meio)
+    ID_NAMES.extend(names)
+    ID_HANDLES.update((name, handle) for handle, name in enumerate(names) if name is not None)
+    ID_REFS.extend(id_refs)
+    ID_FREE.extend(handle for handle, name in enumerate(names) if name is None)
+    GROUPS.update(header["groups"])
+    for name, column in columns.items():
+        setattr(STORE, name, column)
+    STORE.free = free
+    STORE.metas = metas
+    STORE.blobs = refs.tolist()  # índices na tabela; -1 só em slots mortos
+    SNAPSHOT_BLOBS = blobs
+    BLOBS.update(mailboxes)
+    EXPIRY_BUCKETS.now = header["now"]
+    EXPIRY_BUCKETS.buckets.update(buckets)
+    gc.freeze()
+    gc.enable()
+    return sum(lives)
+
+
+# --- Desligamento gracioso e recarga de certificado ---
+async def drain(servers):
+    """Para de aceitar conexões, espera pedidos em andamento e fecha as sessões."""
+    global DRAINING
+    DRAINING = True
+    log.info("")
+    log.info("[server.py][DRAIN] Desligamento gracioso iniciado")
+    log.info("  └─ Sessões abertas: %d", len(SESSIONS))
+    for srv in servers:
+        srv.close()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DRAIN_TIMEOUT
+    for session in SESSIONS:
+        session.closing = True
+    while any(session.busy for session in SESSIONS) and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    for session in list(SESSIONS):
+        await session.close()
+    log.info("  └─ ✅ Sessões encerradas")
+
+
+def reload_certs(sslctx, certfile, keyfile):
+    # novas conexões usam o par recarregado; as existentes seguem com o antigo
+    try:
+        sslctx.load_cert_chain(certfile, keyfile)
     except Exception as e:
-        log.error("[server.py][ERRO] Conexão encerrada com erro: %s", e)
-    finally:
-        writer.close()
-        with contextlib.suppress(builtins.BaseException):
-            await writer.wait_closed()
+        log.error("[server.py][SSL/TLS] ❌ Falha ao recarregar certificado, mantendo o atual: %s", e)
+        return
+    log.info("[server.py][SSL/TLS] ✅ Certificado recarregado: %s", certfile)
 
 
 # --- Main ---
-async def main(certfile, keyfile, host="0.0.0.0", port=4433):
+async def main(certfile, keyfile, host="0.0.0.0", port=4433, ws_port=None, capture=None,
+               snapshot=None):
+    global CAPTURE
     log.info("")
     log.info("[server.py][SSL/TLS] Configurando contexto SSL/TLS")
     log.info("  └─ Arquivo: server.py | Função: main()")
@@ -271,21 +1289,70 @@ async def main(certfile, keyfile, host="0.0.0.0", port=4433):
     sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     sslctx.load_cert_chain(certfile, keyfile)
 
+    if capture:
+        CAPTURE = TrafficCapture(capture)
+
+    if snapshot and Path(snapshot).exists():
+        started = time.perf_counter()
+        try:
+            count = load_snapshot(snapshot)
+        except Exception as e:
+            log.error("[server.py][SNAPSHOT] ❌ Snapshot ilegível, iniciando vazio: %s", e)
+        else:
+            # removido após carregar para não reentregar mensagens num crash posterior
+            Path(snapshot).unlink()
+            log.info("[server.py][SNAPSHOT] %d mensagens e %d grupos restaurados em %.2fs",
+                     count, len(GROUPS), time.perf_counter() - started)
+
+    sweeper = asyncio.create_task(expiry_sweeper())
+    reaper = asyncio.create_task(presence_reaper())
     server = await asyncio.start_server(handle_reader, host, port, ssl=sslctx)
     addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
 
+    ws_server = None
+    if ws_port is not None:
+        # mesmo contexto TLS e mesmo estado; frames texto ou binários
+        ws_server = await websockets.serve(
+            handle_websocket, host, ws_port, ssl=sslctx, compression="deflate"
+        )
+
     log.info("")
     log.info("=" * 70)
     log.info(" SERVIDOR RODANDO")
     log.info("=" * 70)
     log.info("   Endereço: %s", addrs)
     log.info("   TLS: ATIVO")
+    if ws_server is not None:
+        log.info("   WebSocket (wss): porta %d", ws_port)
+    if CAPTURE is not None:
+        log.info("   Captura de tráfego: %s", capture)
+    log.info("   TTL padrão de mensagens: %ds", BLOB_TTL)
     log.info("   Aguardando conexões...")
     log.info("=" * 70)
     log.info("")
 
-    async with server:
-        await server.serve_forever()
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    with contextlib.suppress(NotImplementedError, AttributeError):
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        loop.add_signal_handler(signal.SIGHUP, reload_certs, sslctx, certfile, keyfile)
+
+    try:
+        async with server:
+            await stop.wait()
+            await drain([server] + ([ws_server] if ws_server is not None else []))
+            if snapshot:
+                count = save_snapshot(snapshot)
+                log.info("[server.py][SNAPSHOT] %d mensagens gravadas em %s", count, snapshot)
+    finally:
+        sweeper.cancel()
+        reaper.cancel()
+        if ws_server is not None:
+            ws_server.close()
+        if CAPTURE is not None:
+            CAPTURE.close()
+            log.info("[server.py][CAPTURE] %d comandos gravados em %s", CAPTURE.records, capture)
 
 
 if __name__ == "__main__":
@@ -295,8 +1362,50 @@ if __name__ == "__main__":
     p.add_argument("keyfile")
     p.add_argument("--host", default="0.0.0.0")
     p.add_argument("--port", default=4433, type=int)
+    p.add_argument("--ws-port", default=None, type=int,
+                   help="Porta do listener WebSocket (wss); desativado se omitido")
+    p.add_argument("--lane-weights", default="%d:%d" % LANE_WEIGHTS,
+                   help="Proporção interativo:bulk na entrega, após a faixa de controle")
+    p.add_argument("--presence-window", default=PRESENCE_WINDOW, type=float,
+                   help="Janela (s) para agrupar atualizações de presença")
+    p.add_argument("--presence-timeout", default=PRESENCE_TIMEOUT, type=float,
+                   help="Segundos sem pedidos até um cliente TLS ser dado como offline")
+    p.add_argument("--snapshot", default=None,
+                   help="Arquivo de snapshot: carregado na partida e gravado no desligamento")
+    p.add_argument("--drain-timeout", default=DRAIN_TIMEOUT, type=float,
+                   help="Segundos esperando pedidos em andamento ao desligar")
+    p.add_argument("--capture", default=None,
+                   help="Grava o fluxo de comandos (blobs anonimizados) neste arquivo")
+    p.add_argument("--blob-ttl", default=BLOB_TTL, type=float,
+                   help="TTL padrão (s) de mensagens não entregues")
+    p.add_argument("--max-blob-ttl", default=BLOB_TTL_MAX, type=float,
+                   help="TTL máximo (s) aceito por mensagem")
+    p.add_argument("--reject-unknown", action="store_true",
+                   help="Recusa envios para IDs sem chave pública publicada")
+    p.add_argument("--idle-timeout", default=IDLE_TIMEOUT, type=float,
+                   help="Segundos sem atividade antes de encerrar a conexão")
+    p.add_argument("--write-timeout", default=WRITE_TIMEOUT, type=float,
+                   help="Segundos esperando o cliente consumir uma resposta")
+    p.add_argument("--max-connections", default=MAX_CONNECTIONS, type=int,
+                   help="Conexões simultâneas antes de recusar novas")
     args = p.parse_args()
+    if not 0 < args.blob_ttl <= args.max_blob_ttl <= BLOB_TTL_LIMIT:
+        p.error(f"exigido 0 < --blob-ttl <= --max-blob-ttl <= {BLOB_TTL_LIMIT}")
+    if not 0 < args.presence_timeout < math.inf:
+        p.error("--presence-timeout deve ser positivo")
+    BLOB_TTL = args.blob_ttl
+    BLOB_TTL_MAX = args.max_blob_ttl
+    REJECT_UNKNOWN = args.reject_unknown
+    IDLE_TIMEOUT = args.idle_timeout
+    WRITE_TIMEOUT = args.write_timeout
+    MAX_CONNECTIONS = args.max_connections
+    PRESENCE_WINDOW = args.presence_window
+    PRESENCE_TIMEOUT = args.presence_timeout
+    PRESENCE_BUCKETS = ExpiryBuckets(min(1.0, PRESENCE_TIMEOUT / 4), new_bucket=list)
+    LANE_WEIGHTS = tuple(max(1, int(w)) for w in args.lane_weights.split(":"))
+    DRAIN_TIMEOUT = args.drain_timeout
     try:
-        asyncio.run(main(args.certfile, args.keyfile, args.host, args.port))
+        asyncio.run(main(args.certfile, args.keyfile, args.host, args.port, args.ws_port, args.capture,
+                         args.snapshot))
     except KeyboardInterrupt:
         log.info("\n[server.py] Servidor encerrado pelo usuário")
\ No newline at end of file
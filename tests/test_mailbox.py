@@ -0,0 +1,105 @@
+"""Entrega ponderada do Mailbox entre as faixas interativa e bulk.
+
+Rode com: python -m unittest discover tests
+"""
+import asyncio
+import base64
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+import server  # noqa: E402
+
+
+def reset():
+    server.STORE = server.MessageStore()
+    server.EXPIRY_BUCKETS = server.ExpiryBuckets()
+    server.BLOBS.clear()
+    server.ID_NAMES.clear()
+    server.ID_HANDLES.clear()
+    server.ID_REFS = server.array.array("I")
+    server.ID_FREE.clear()
+
+
+class MailboxTakeTest(unittest.TestCase):
+    def setUp(self):
+        reset()
+
+    def fill(self, n_inter, n_bulk):
+        for i in range(n_inter):
+            server.enqueue_blob(server.intern_id("bob"), server.intern_id("alice"), b"i%d" % i, 60)
+        for i in range(n_bulk):
+            server.enqueue_blob(server.intern_id("bob"), server.intern_id("alice"), b"b%d" % i, 60,
+                                lane=server.BULK)
+        return server.BLOBS[server.ID_HANDLES["bob"]]
+
+    def drain(self, mailbox, limit, calls):
+        blobs = []
+        for _ in range(calls):
+            blobs += [m["blob"] for m in mailbox.take(limit)]
+        return blobs
+
+    def test_small_limits_still_deliver_bulk(self):
+        w_inter, w_bulk = server.LANE_WEIGHTS
+        for limit in (1, 2, 3, 4):
+            with self.subTest(limit=limit):
+                reset()
+                mailbox = self.fill(100, 100)
+                blobs = self.drain(mailbox, limit, 50 // limit)
+                n = len(blobs)
+                bulk = sum(1 for b in blobs if base64.b64decode(b).startswith(b"b"))
+                self.assertEqual(n, 50 // limit * limit)
+                # a cada ciclo completo, exatamente w_bulk entregas são bulk
+                self.assertEqual(bulk, n // (w_inter + w_bulk) * w_bulk + max(0, n % (w_inter + w_bulk) - w_inter))
+
+    def test_empty_lane_yields_its_turn(self):
+        mailbox = self.fill(0, 5)
+        self.assertEqual(len(self.drain(mailbox, 1, 5)), 5)
+        mailbox = self.fill(3, 0)
+        self.assertEqual(len(self.drain(mailbox, 2, 2)), 3)
+
+    def test_order_within_lane(self):
+        mailbox = self.fill(8, 2)
+        blobs = [base64.b64decode(b) for b in self.drain(mailbox, 10, 1)]
+        self.assertEqual(blobs, [b"i0", b"i1", b"i2", b"i3", b"b0", b"i4", b"i5", b"i6", b"i7", b"b1"])
+
+
+class LanePriorityTest(unittest.TestCase):
+    """A faixa de controle não pode ser escolhida pelo cliente."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        reset()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def send(self, text, **extra):
+        msg = {"type": "send_blob", "to": "bob", "from": "alice",
+               "blob": base64.b64encode(text).decode(), **extra}
+        return asyncio.run(server.handle_command(None, msg))
+
+    def first(self):
+        [m] = server.BLOBS[server.ID_HANDLES["bob"]].take(1)
+        return base64.b64decode(m["blob"])
+
+    def test_client_cannot_pick_control(self):
+        for i in range(5):
+            self.send(b"chat%d" % i)
+        resp = self.send(b"spam", priority="control")
+        self.assertEqual(resp["status"], "error")
+        self.assertEqual(self.first(), b"chat0")
+
+    def test_group_key_goes_first(self):
+        for i in range(5):
+            self.send(b"chat%d" % i)
+        self.send(b"bulk", priority="bulk")
+        resp = self.send(b"chave", kind="group_key", group_id="g1", priority="bulk")
+        self.assertEqual(resp["status"], "ok")
+        self.assertEqual(self.first(), b"chave")
+
+
+if __name__ == "__main__":
+    unittest.main()
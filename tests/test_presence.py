@@ -0,0 +1,52 @@
+"""Last-seen dos clientes TLS expirado por baldes.
+
+Rode com: python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+import server  # noqa: E402
+
+
+class PresenceTest(unittest.TestCase):
+    def setUp(self):
+        server.PRESENCE_TIMEOUT = 3.0
+        server.PRESENCE_BUCKETS = server.ExpiryBuckets(1.0, new_bucket=list)
+        server.LAST_SEEN.clear()
+        server.ACTIVE_CLIENTS.clear()
+
+    def ticks(self, n):
+        for _ in range(n):
+            server.expire_presence()
+
+    def test_offline_after_timeout(self):
+        server.touch("a")
+        self.ticks(3)
+        self.assertTrue(server.is_online("a"))
+        self.ticks(1)
+        self.assertFalse(server.is_online("a"))
+
+    def test_touch_postpones(self):
+        server.touch("a")
+        self.ticks(2)
+        server.touch("a")
+        self.ticks(3)
+        self.assertTrue(server.is_online("a"))
+        self.ticks(1)
+        self.assertFalse(server.is_online("a"))
+        self.assertEqual(server.PRESENCE_BUCKETS.buckets, {})
+
+    def test_each_tick_only_visits_its_bucket(self):
+        for i in range(1000):
+            server.touch("c%d" % i)
+        self.ticks(3)
+        self.assertEqual(len(server.LAST_SEEN), 1000)
+        self.assertEqual(list(server.PRESENCE_BUCKETS.buckets), [4])
+        self.ticks(1)
+        self.assertEqual(server.LAST_SEEN, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""Snapshot do estado: ida e volta e arquivos danificados.
+
+Rode com: python -m unittest discover tests
+"""
+import base64
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+import server  # noqa: E402
+
+
+def reset():
+    server.STORE = server.MessageStore()
+    server.EXPIRY_BUCKETS = server.ExpiryBuckets()
+    server.SNAPSHOT_BLOBS = None
+    server.BLOBS.clear()
+    server.GROUPS.clear()
+    server.ID_NAMES.clear()
+    server.ID_HANDLES.clear()
+    server.ID_REFS = server.array.array("I")
+    server.ID_FREE.clear()
+
+
+def fetch(name):
+    mailbox = server.BLOBS.get(server.ID_HANDLES.get(name))
+    if mailbox is None:
+        return []
+    return [(m["type"], m["from"], base64.b64decode(m["blob"]), m.get("kid")) for m in mailbox.take()]
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        reset()
+        fd, self.path = tempfile.mkstemp(suffix=".snap")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def populate(self):
+        bob, ana, alice = (server.intern_id(n) for n in ("bob", "ana", "alice"))
+        server.GROUPS["g1"] = {"members": ["alice", "bob", "ana"], "admin": "alice"}
+        for i in range(6):
+            server.enqueue_blob(bob, alice, b"p%d" % i, 60, kid=0xABC)
+        server.enqueue_blob(bob, alice, b"k", 60, kind=server.GROUP_KEY,
+                            group=server.intern_id("g1"), kid=1, lane=server.CONTROL)
+        shared = b"grupo"  # fan-out: o mesmo bytes em duas caixas
+        server.enqueue_blob(bob, alice, shared, 60, kind=server.GROUP, group=server.intern_id("g1"))
+        server.enqueue_blob(ana, alice, shared, 60, kind=server.GROUP, group=server.intern_id("g1"))
+        server.enqueue_blob(ana, alice, b"bulk", 60, lane=server.BULK)
+        # lápides e lista livre: entrega parte da caixa de bob e reaproveita um slot
+        server.BLOBS[bob].take(2)
+        server.enqueue_blob(ana, alice, b"reuso", 60)
+
+    def test_round_trip(self):
+        self.populate()
+        count = server.save_snapshot(self.path)
+        id_refs = dict(zip(server.ID_NAMES, server.ID_REFS))
+        expected = {name: fetch(name) for name in ("bob", "ana")}
+        self.assertEqual(count, sum(len(v) for v in expected.values()))
+
+        reset()
+        self.assertEqual(server.load_snapshot(self.path), count)
+        self.assertEqual(dict(zip(server.ID_NAMES, server.ID_REFS)), id_refs)
+        self.assertEqual(server.GROUPS["g1"]["members"], ["alice", "bob", "ana"])
+        self.assertEqual({name: fetch(name) for name in ("bob", "ana")}, expected)
+        self.assertIn(("private", "alice", b"p5", "0000000000000abc"), expected["bob"])
+
+        # o estado restaurado continua utilizável: slots livres e novas mensagens
+        server.enqueue_blob(server.intern_id("bob"), server.intern_id("ana"), b"novo", 60)
+        self.assertEqual(fetch("bob"), [("private", "ana", b"novo", None)])
+
+    def test_expiry_survives_restart(self):
+        self.populate()
+        server.save_snapshot(self.path)
+        reset()
+        server.load_snapshot(self.path)
+        for _ in range(61):
+            server.expire_due()
+        self.assertEqual(server.BLOBS, {})
+        self.assertEqual(server.ID_HANDLES, {})
+
+    def test_expired_ids_leave_the_table(self):
+        self.populate()
+        sizes = []
+        for _ in range(2):
+            for i in range(1000):
+                server.enqueue_blob(server.intern_id("fantasma%d" % i), server.intern_id("x%d" % i), b"?", 5)
+            for _ in range(6):
+                server.expire_due()
+            self.assertEqual(sorted(server.ID_HANDLES), ["alice", "ana", "bob", "g1"])
+            sizes.append(len(server.ID_NAMES))
+        self.assertEqual(sizes[0], sizes[1])  # handles livres são reaproveitados
+        server.save_snapshot(self.path)
+        self.assertNotIn(b"fantasma", open(self.path, "rb").read())
+
+        # a caixa entregue solta o handle do destinatário
+        server.enqueue_blob(server.intern_id("carla"), server.intern_id("ana"), b"oi", 60)
+        mailbox = server.BLOBS[server.ID_HANDLES["carla"]]
+        mailbox.take()
+        server.drop_mailbox(server.ID_HANDLES["carla"], mailbox)
+        self.assertNotIn("carla", server.ID_HANDLES)
+        self.assertIn("ana", server.ID_HANDLES)
+
+    def test_truncated_file_leaves_state_empty(self):
+        self.populate()
+        server.save_snapshot(self.path)
+        size = os.path.getsize(self.path)
+        for cut in (40, 1, size // 2, size - 10):
+            with self.subTest(cut=cut):
+                reset()
+                with open(self.path, "rb") as f:
+                    data = f.read()
+                damaged = self.path + ".cut"
+                with open(damaged, "wb") as f:
+                    f.write(data[:-cut])
+                try:
+                    with self.assertRaises(Exception):
+                        server.load_snapshot(damaged)
+                finally:
+                    os.unlink(damaged)
+                self.assertEqual(len(server.STORE), 0)
+                self.assertEqual(server.BLOBS, {})
+                self.assertEqual(server.ID_NAMES, [])
+                self.assertEqual(len(server.ID_REFS), 0)
+                self.assertEqual(server.GROUPS, {})
+                self.assertIsNone(server.SNAPSHOT_BLOBS)
+                self.assertEqual(server.EXPIRY_BUCKETS.buckets, {})
+
+    def test_trailing_garbage_rejected(self):
+        self.populate()
+        server.save_snapshot(self.path)
+        with open(self.path, "ab") as f:
+            f.write(b"\0" * 8)
+        reset()
+        with self.assertRaises(ValueError):
+            server.load_snapshot(self.path)
+        self.assertEqual(server.BLOBS, {})
+
+
+if __name__ == "__main__":
+    unittest.main()